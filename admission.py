@@ -0,0 +1,384 @@
+"""Admission control and load shedding.
+
+Every request takes a slot out of a shared capacity. Requests to the
+expensive endpoints (``ADMISSION_LIMITS``) are low priority: they also
+need a slot under their endpoint's own limit, may not use the last
+``ADMISSION_RESERVE`` slots of the capacity, and each client may only start
+them as fast as its token bucket allows. Cheap pages are high priority and
+only need a capacity slot.
+
+A request that finds no slot waits in a short, bounded priority queue.
+Freed slots go to the waiting cheap requests first, then to the expensive
+ones, first come first served within each class; a waiter that cannot use
+the freed slot (its endpoint is at its limit) does not hold up the ones
+behind it. When the queue is full, a cheap request takes the place of the
+newest expensive waiter, which is shed. Otherwise a request is shed with
+``503`` when the queue is full or its wait times out. A client out of
+tokens is shed with ``429`` straight away. Both carry a Retry-After
+header.
+
+The queue is per worker process. With the shared backend, slots freed by
+other workers are noticed by polling every ``SharedBackend.POLL`` seconds,
+so priority order holds within each worker rather than across them.
+
+Two backends hold the counters. ``LocalBackend`` keeps them in the process
+and suits a single worker. ``SharedBackend`` keeps them in a memory-mapped
+file, so all workers on a host share the limits. Each worker counts in its
+own row there, and rows of dead workers are ignored, so a killed worker
+never leaks its slots.
+"""
+import bisect
+import contextlib
+import fcntl
+import itertools
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from flask import Response, g, request
+
+from lifecycle import INTERNAL, on_request_done
+
+
+class Rejected(Exception):
+
+    def __init__(self, status, retry_after):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def refill(tokens, stamp, now, rate, burst):
+    """Tokens left in a bucket last updated at ``stamp``."""
+    return min(burst, tokens + (now - stamp) * rate)
+
+
+class LocalBackend:
+    """Counters for a single worker process."""
+
+    POLL = None
+
+    def __init__(self, endpoints):
+        self._lock = threading.Lock()
+        self._total = 0
+        self._active = dict.fromkeys(endpoints, 0)
+        self._buckets = {}
+        self._prune_at = 100000
+
+    def acquire(self, endpoint, limit, capacity):
+        with self._lock:
+            if self._total >= capacity:
+                return False
+            if limit is not None and self._active[endpoint] >= limit:
+                return False
+            self._total += 1
+            if limit is not None:
+                self._active[endpoint] += 1
+            return True
+
+    def release(self, endpoint, limited):
+        with self._lock:
+            self._total -= 1
+            if limited:
+                self._active[endpoint] -= 1
+
+    def take_token(self, client, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.get(client, (burst, now))
+            tokens = refill(tokens, stamp, now, rate, burst)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                return (1 - tokens) / rate
+            self._buckets[client] = (tokens - 1, now)
+            if len(self._buckets) > self._prune_at:
+                # drop the buckets that have refilled, they hold no state
+                self._buckets = {
+                    key: value for key, value in self._buckets.items()
+                    if refill(*value, now, rate, burst) < burst}
+                self._prune_at = max(100000, 2 * len(self._buckets))
+            return 0
+
+
+class SharedBackend:
+    """Counters in a memory-mapped file shared by the workers on a host.
+
+    The file holds ``WORKERS`` rows of ``pid, total, active per endpoint``
+    followed by a direct-mapped table of ``BUCKETS`` token buckets keyed by
+    a hash of the client. Clients that collide on a slot take it over with
+    a full bucket, which errs on the side of admitting them.
+    """
+
+    WORKERS = 64
+    BUCKETS = 4096
+    POLL = 0.01
+    _BUCKET = struct.Struct('=Qdd')
+
+    def __init__(self, endpoints, path=None):
+        self._endpoints = {name: i for i, name in enumerate(sorted(endpoints))}
+        self._row = struct.Struct('=q%dq' % (len(endpoints) + 1))
+        self._buckets_at = self.WORKERS * self._row.size
+        size = self._buckets_at + self.BUCKETS * self._BUCKET.size
+        path = path or os.path.join(
+            '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+            'fyyur-admission')
+        self._file = open(path, 'a+b')
+        with self._locked():
+            if os.fstat(self._file.fileno()).st_size != size:
+                self._file.truncate(0)
+                self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._thread_lock = threading.Lock()
+        self._slot = None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _rows(self):
+        for slot in range(self.WORKERS):
+            yield slot, self._row.unpack_from(self._map, slot * self._row.size)
+
+    def _alive(self, pid):
+        if pid == 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _own_row(self):
+        # claimed lazily, so forked workers get their own row
+        pid = os.getpid()
+        if self._slot is not None:
+            slot, owner = self._slot
+            if owner == pid:
+                return slot
+        free = None
+        for slot, row in self._rows():
+            if row[0] == pid:
+                free = slot
+                break
+            if free is None and not self._alive(row[0]):
+                free = slot
+        if free is None:
+            raise RuntimeError('more than %d workers share admission '
+                               'counters' % self.WORKERS)
+        empty = [0] * (self._row.size // 8 - 1)
+        self._row.pack_into(self._map, free * self._row.size, pid, *empty)
+        self._slot = (free, pid)
+        return free
+
+    def _update(self, index, delta):
+        slot = self._own_row()
+        row = list(self._row.unpack_from(self._map, slot * self._row.size))
+        row[index] += delta
+        self._row.pack_into(self._map, slot * self._row.size, *row)
+
+    def acquire(self, endpoint, limit, capacity):
+        column = self._endpoints.get(endpoint)
+        with self._thread_lock, self._locked():
+            total = active = 0
+            for _, row in self._rows():
+                if self._alive(row[0]):
+                    total += row[1]
+                    if column is not None:
+                        active += row[2 + column]
+            if total >= capacity:
+                return False
+            if limit is not None and active >= limit:
+                return False
+            self._update(1, 1)
+            if limit is not None:
+                self._update(2 + column, 1)
+            return True
+
+    def release(self, endpoint, limited):
+        with self._thread_lock, self._locked():
+            self._update(1, -1)
+            if limited:
+                self._update(2 + self._endpoints[endpoint], -1)
+
+    def take_token(self, client, rate, burst):
+        key = zlib.crc32(client.encode()) | 1
+        offset = self._buckets_at + (key % self.BUCKETS) * self._BUCKET.size
+        now = time.time()
+        with self._thread_lock, self._locked():
+            owner, tokens, stamp = self._BUCKET.unpack_from(self._map, offset)
+            if owner != key:
+                tokens, stamp = burst, now
+            tokens = refill(tokens, stamp, now, rate, burst)
+            if tokens < 1:
+                self._BUCKET.pack_into(self._map, offset, key, tokens, now)
+                return (1 - tokens) / rate
+            self._BUCKET.pack_into(self._map, offset, key, tokens - 1, now)
+            return 0
+
+
+class Waiter:
+
+    def __init__(self, endpoint, limit, capacity, priority):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.capacity = capacity
+        self.priority = priority
+        # None while waiting, then True (holds a slot) or False (shed)
+        self.admitted = None
+        self.done = threading.Event()
+
+
+class Admission:
+
+    HIGH, LOW = 0, 1
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_BACKEND', 'local')
+        app.config.setdefault('ADMISSION_CAPACITY', 32)
+        app.config.setdefault('ADMISSION_RESERVE', 8)
+        app.config.setdefault('ADMISSION_LIMITS', {})
+        app.config.setdefault('ADMISSION_QUEUE_DEPTH', 16)
+        app.config.setdefault('ADMISSION_QUEUE_TIMEOUT', 0.5)
+        app.config.setdefault('ADMISSION_RETRY_AFTER', 1)
+        app.config.setdefault('ADMISSION_EXEMPT', ('static',))
+        app.config.setdefault('RATE_LIMIT_RATE', 2.0)
+        app.config.setdefault('RATE_LIMIT_BURST', 10)
+        self.capacity = app.config['ADMISSION_CAPACITY']
+        self.reserve = app.config['ADMISSION_RESERVE']
+        self.limits = app.config['ADMISSION_LIMITS']
+        self.queue_depth = app.config['ADMISSION_QUEUE_DEPTH']
+        self.queue_timeout = app.config['ADMISSION_QUEUE_TIMEOUT']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        self.exempt = frozenset(app.config['ADMISSION_EXEMPT'])
+        self.rate = app.config['RATE_LIMIT_RATE']
+        self.burst = app.config['RATE_LIMIT_BURST']
+        if app.config['ADMISSION_BACKEND'] == 'shared':
+            self.backend = SharedBackend(self.limits,
+                                         app.config.get('ADMISSION_SHARED_PATH'))
+        else:
+            self.backend = LocalBackend(self.limits)
+        # (priority, arrival, Waiter), kept sorted
+        self._waiting = []
+        self._arrivals = itertools.count()
+        self._queue_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = dict.fromkeys(('admitted', 'queued', 'rate_limited',
+                                    'shed'), 0)
+        app.before_request(self.before_request)
+        # a streamed page keeps its slot until the stream is closed
+        on_request_done(app, 'admitted',
+                        lambda endpoint, status: self.release(endpoint))
+
+    def admit(self, endpoint, client):
+        """Take a slot for ``endpoint`` or raise ``Rejected``."""
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            priority, capacity = self.HIGH, self.capacity
+        else:
+            wait = self.backend.take_token(client, self.rate, self.burst)
+            if wait:
+                self._count('rate_limited')
+                raise Rejected(429, max(1, math.ceil(wait)))
+            priority, capacity = self.LOW, self.capacity - self.reserve
+        with self._queue_lock:
+            # never overtake a waiter of the same or a higher priority
+            ahead = any(waiter.priority <= priority
+                        for _, _, waiter in self._waiting)
+            if not ahead and self.backend.acquire(endpoint, limit, capacity):
+                return
+            waiter = self._enqueue(Waiter(endpoint, limit, capacity, priority))
+            # the waiters ahead may be held by their own endpoint limits
+            # only, which leaves this one free to go now
+            self._hand_out()
+        self._count('queued')
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            left = deadline - time.monotonic()
+            poll = self.backend.POLL
+            if waiter.done.wait(max(0, min(left, poll) if poll else left)):
+                break
+            if left <= 0:
+                with self._queue_lock:
+                    if waiter.admitted is None:
+                        self._remove(waiter)
+                        waiter.admitted = False
+                break
+            # slots freed by other workers are not announced
+            self._dispatch()
+        if not waiter.admitted:
+            raise Rejected(503, self.retry_after)
+
+    def _enqueue(self, waiter):
+        # called with the queue lock held
+        if len(self._waiting) >= self.queue_depth:
+            newest = self._waiting[-1][2]
+            if newest.priority <= waiter.priority:
+                raise Rejected(503, self.retry_after)
+            self._waiting.pop()
+            newest.admitted = False
+            newest.done.set()
+        # arrivals are unique, so waiters themselves are never compared
+        bisect.insort(self._waiting,
+                      (waiter.priority, next(self._arrivals), waiter))
+        return waiter
+
+    def _remove(self, waiter):
+        self._waiting = [entry for entry in self._waiting
+                         if entry[2] is not waiter]
+
+    def _dispatch(self):
+        """Hand free slots to the waiters, in priority order."""
+        with self._queue_lock:
+            self._hand_out()
+
+    def _hand_out(self):
+        # called with the queue lock held
+        for entry in list(self._waiting):
+            waiter = entry[2]
+            if self.backend.acquire(waiter.endpoint, waiter.limit,
+                                    waiter.capacity):
+                self._waiting.remove(entry)
+                waiter.admitted = True
+                waiter.done.set()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def before_request(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in self.exempt or \
+                request.environ.get(INTERNAL):
+            return None
+        try:
+            self.admit(endpoint, request.remote_addr or '-')
+        except Rejected as rejected:
+            if rejected.status == 503:
+                self._count('shed')
+            return Response(
+                'Too many requests\n' if rejected.status == 429
+                else 'Server busy, try again shortly\n',
+                rejected.status, mimetype='text/plain',
+                headers={'Retry-After': str(rejected.retry_after)})
+        self._count('admitted')
+        g.admitted = endpoint
+
+    def release(self, endpoint):
+        self.backend.release(endpoint, endpoint in self.limits)
+        if self._waiting:
+            self._dispatch()
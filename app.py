@@ -3,18 +3,39 @@
 #----------------------------------------------------------------------------#
 
 import json
-import dateutil.parser
-import babel
-from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify
+from flask import Flask, render_template, request, Response, flash, redirect, url_for, jsonify, abort, stream_with_context, get_flashed_messages, before_render_template, template_rendered
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.http import http_date, is_resource_modified
 import logging
 from logging import Formatter, FileHandler
 from flask_wtf import Form
 from forms import *
-from flask_migrate import Migrate
+from genres import GenreIndex, contains_all
+import geo
+from matchmaking import Matchmaker
+from autocomplete import PrefixIndex
+from dedupe import DuplicateIndex
+from jobs import JobQueue
+from cache import SnapshotCache
+from compression import Compress
+from admission import Admission
+from profiler import Profiler
+from lifecycle import INTERNAL
+from feed import Broadcaster, Subscription
+import ical
+import recurrence
+import snapshot
+import click
+import os
 import sys
+import threading
+import time
 import datetime
+import heapq
+import itertools
+import zlib
+from collections import namedtuple
 #----------------------------------------------------------------------------#
 # App Config.
 #----------------------------------------------------------------------------#
@@ -23,7 +44,40 @@ app = Flask(__name__)
 moment = Moment(app)
 app.config.from_object('config')
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+compress = Compress(app)
+admission = Admission(app)
+profiler = Profiler(app)
+
+
+class LazyMigrateCommands(click.Group):
+    # Flask-Migrate pulls in all of alembic, which only `flask db` commands
+    # need, so it is set up the first time one of them is looked up.
+    def load(self):
+        if 'migrate' not in app.extensions:
+            from flask_migrate import Migrate
+            Migrate(app, db)
+        return app.cli.commands['db']
+
+    def list_commands(self, ctx):
+        return self.load().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self.load().get_command(ctx, name)
+
+
+def template_cache():
+    from jinja2 import FileSystemBytecodeCache
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+    return FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+
+if app.config['FAST_STARTUP']:
+    app.cli.add_command(LazyMigrateCommands(
+        'db', help='Perform database migrations.'))
+    app.jinja_env.bytecode_cache = template_cache()
+else:
+    from flask_migrate import Migrate
+    migrate = Migrate(app, db)
 
 #----------------------------------------------------------------------------#
 # Models.
@@ -32,6 +86,11 @@ migrate = Migrate(app, db)
 
 class Venue(db.Model):
     __tablename__ = 'Venue'
+    __table_args__ = (
+        db.Index('ix_Venue_genres', 'genres', postgresql_using='gin'),
+        db.Index('ix_Venue_geohash_prefix', 'geohash',
+                 postgresql_ops={'geohash': 'varchar_pattern_ops'}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
@@ -45,6 +104,11 @@ class Venue(db.Model):
     website = db.Column(db.String())
     seeking_talent = db.Column(db.String(120))
     seeking_description = db.Column(db.String())
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(geo.PRECISION))
     shows = db.relationship('Show', backref="venue",
                             passive_deletes=True, lazy=True)
 
@@ -66,6 +130,9 @@ class Venue(db.Model):
 
 class Artist(db.Model):
     __tablename__ = 'Artist'
+    __table_args__ = (
+        db.Index('ix_Artist_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String)
@@ -78,6 +145,8 @@ class Artist(db.Model):
     website = db.Column(db.String())
     seeking_venue = db.Column(db.String(120))
     seeking_description = db.Column(db.String())
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
     shows = db.relationship('Show', backref="artist",
                             passive_deletes=True, lazy=True)
 
@@ -114,11 +183,872 @@ class Show(db.Model):
                 )
 
 
+class Residency(db.Model):
+    __tablename__ = 'Residency'
+
+    # a recurring show, expanded into occurrences only when a page asks
+    id = db.Column(db.Integer, primary_key=True)
+    artist_id = db.Column(db.Integer, db.ForeignKey(
+        'Artist.id', ondelete='CASCADE'), nullable=False)
+    venue_id = db.Column(db.Integer, db.ForeignKey(
+        'Venue.id', ondelete='CASCADE'), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    frequency = db.Column(db.String(10), nullable=False)
+    interval = db.Column(db.Integer, nullable=False, default=1)
+    until = db.Column(db.DateTime)
+    count = db.Column(db.Integer)
+    exceptions = db.relationship('ResidencyException', backref='residency',
+                                 passive_deletes=True, lazy=True)
+
+    def __repr__(self):
+        return ("-------------RESIDENCY-------------\n"
+                f"artist_id:  {self.artist_id}\n"
+                f"venue_id:   {self.venue_id}\n"
+                f"starts_at:  {self.starts_at}\n"
+                f"frequency:  {self.frequency} x{self.interval}\n"
+                f"until:      {self.until}\n"
+                f"count:      {self.count}\n\n"
+                )
+
+
+class ResidencyException(db.Model):
+    __tablename__ = 'ResidencyException'
+    __table_args__ = (
+        db.UniqueConstraint('residency_id', 'occurs_at'),
+    )
+
+    # moved_to empty: the occurrence at occurs_at is cancelled
+    id = db.Column(db.Integer, primary_key=True)
+    residency_id = db.Column(db.Integer, db.ForeignKey(
+        'Residency.id', ondelete='CASCADE'), nullable=False)
+    occurs_at = db.Column(db.DateTime, nullable=False)
+    moved_to = db.Column(db.DateTime)
+
+
+class Change(db.Model):
+    __tablename__ = 'Change'
+    __table_args__ = (
+        db.Index('ix_Change_venue_id', 'venue_id', 'id'),
+        db.Index('ix_Change_artist_id', 'artist_id', 'id'),
+    )
+
+    # venue_id alone: the venue itself changed, which also shows on the
+    # pages of artists playing there (artist_id alone likewise).
+    # Both set: only the pages of that venue and that artist changed.
+    id = db.Column(db.Integer, primary_key=True)
+    venue_id = db.Column(db.Integer)
+    artist_id = db.Column(db.Integer)
+    changed_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+
+def record_change(venue_id=None, artist_id=None):
+    db.session.add(Change(venue_id=venue_id, artist_id=artist_id))
+
+
+class FeedEvent(db.Model):
+    __tablename__ = 'FeedEvent'
+
+    # one row per newly listed show, written in the show's own transaction;
+    # the id is the event id every worker sends for it
+    id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.datetime.utcnow)
+
+
+#----------------------------------------------------------------------------#
+# Projections.
+#----------------------------------------------------------------------------#
+
+# Read-only listing and search pages only need a few columns, so they select
+# those columns straight into namedtuples instead of loading full entities.
+# Column queries bypass the session identity map, so nothing is tracked.
+
+VenueSummary = namedtuple('VenueSummary', ['id', 'name', 'city', 'state'])
+ArtistSummary = namedtuple('ArtistSummary', ['id', 'name'])
+
+
+# With lazy=True rows are fetched in batches as the caller iterates, which
+# lets streamed pages start sending before the query has finished.
+
+def venue_summaries(*criteria, lazy=False):
+    query = db.session.query(Venue.id, Venue.name, Venue.city, Venue.state)
+    query = query.filter(*criteria).order_by(
+        Venue.state, Venue.city, Venue.name)
+    if lazy:
+        return map(VenueSummary._make, query.yield_per(1000))
+    return [VenueSummary._make(row) for row in query]
+
+
+def artist_summaries(*criteria, lazy=False):
+    query = db.session.query(Artist.id, Artist.name)
+    query = query.filter(*criteria).order_by(Artist.name)
+    if lazy:
+        return map(ArtistSummary._make, query.yield_per(1000))
+    return [ArtistSummary._make(row) for row in query]
+
+
+def group_by_area(venues):
+    # venues arrive sorted by state then city, so each area is one run
+    return (
+        {"city": city, "state": state, "venues": list(group)}
+        for (state, city), group in itertools.groupby(
+            venues, key=lambda venue: (venue.state, venue.city))
+    )
+
+
+#----------------------------------------------------------------------------#
+# Streaming.
+#----------------------------------------------------------------------------#
+
+def stream_page(template_name, **context):
+    # Jinja renders while the response is sent, so the first bytes leave
+    # before the query is exhausted and memory stays at one buffer of rows.
+    app.update_template_context(context)
+    # The session cookie goes out with the headers, before the layout runs,
+    # so flashes are popped now; popped while streaming they would still be
+    # in the cookie and show up again on the next page.
+    flashes = get_flashed_messages(with_categories=True)
+
+    def flashed(with_categories=False, category_filter=()):
+        found = [(category, message) for category, message in flashes
+                 if not category_filter or category in category_filter]
+        return found if with_categories else [message for _, message in found]
+
+    context['get_flashed_messages'] = flashed
+    template = app.jinja_env.get_template(template_name)
+    # the same signals render_template sends, so listeners such as the
+    # profiler see streamed pages too
+    before_render_template.send(app, template=template, context=context)
+
+    def generate():
+        stream = template.stream(**context)
+        stream.enable_buffering(app.config['STREAM_BUFFER'])
+        yield from stream
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+def peek(rows):
+    """(has_rows, rows) without losing the first row of an iterator."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return False, iter(())
+    return True, itertools.chain([first], rows)
+
+
+#----------------------------------------------------------------------------#
+# Identity cache.
+#----------------------------------------------------------------------------#
+
+# Venue and Artist rows are cached across requests as immutable namedtuple
+# snapshots keyed by id. Edit and delete handlers invalidate their entry,
+# and other workers drop it when they read the Change row (see Change sync),
+# so a stale entry outlives a write by about CHANGE_POLL seconds. The TTL
+# is the bound for rows written without one.
+
+VenueRecord = namedtuple('VenueRecord', Venue.__table__.columns.keys())
+ArtistRecord = namedtuple('ArtistRecord', Artist.__table__.columns.keys())
+
+venue_cache = SnapshotCache(app.config['IDENTITY_CACHE_SIZE'],
+                            app.config['IDENTITY_CACHE_TTL'])
+artist_cache = SnapshotCache(app.config['IDENTITY_CACHE_SIZE'],
+                             app.config['IDENTITY_CACHE_TTL'])
+
+
+def snapshots(model, record, ids):
+    rows = db.session.query(*model.__table__.columns) \
+        .filter(model.id.in_(list(ids)))
+    return {
+        row.id: record._make(
+            tuple(value) if isinstance(value, list) else value
+            for value in row)
+        for row in rows
+    }
+
+
+def get_venue(venue_id):
+    return venue_cache.get(venue_id, lambda key: snapshots(
+        Venue, VenueRecord, [key]).get(key))
+
+
+def get_venues(venue_ids):
+    return venue_cache.get_many(venue_ids, lambda keys: snapshots(
+        Venue, VenueRecord, keys))
+
+
+def get_artist(artist_id):
+    return artist_cache.get(artist_id, lambda key: snapshots(
+        Artist, ArtistRecord, [key]).get(key))
+
+
+def get_artists(artist_ids):
+    return artist_cache.get_many(artist_ids, lambda keys: snapshots(
+        Artist, ArtistRecord, keys))
+
+
+#----------------------------------------------------------------------------#
+# Genre facets.
+#----------------------------------------------------------------------------#
+
+# PostgreSQL filters with array containment (served by the GIN indexes) and
+# counts facets with one unnest/group by query. Other backends use an
+# in-app inverted index that the write handlers keep up to date.
+
+venue_genres = GenreIndex()
+artist_genres = GenreIndex()
+
+
+def faceted(model, index, summarize, selected, *criteria, lazy=False):
+    if db.engine.dialect.name == 'postgresql':
+        if selected:
+            criteria += (contains_all(model.genres, selected),)
+        genre = db.func.unnest(model.genres).label('genre')
+        matching = db.session.query(genre).filter(*criteria).subquery()
+        counts = dict(db.session.query(matching.c.genre, db.func.count())
+                      .group_by(matching.c.genre))
+        rows = summarize(*criteria, lazy=lazy)
+    else:
+        if not index.built:
+            index.rebuild(db.session.query(model.id, model.genres))
+        wanted = index.matching(selected)
+        rows = summarize(*criteria, lazy=lazy and not criteria)
+        if selected:
+            rows = (row for row in rows if row.id in wanted)
+        if criteria:
+            # only the rows themselves say which entities the search matched
+            rows = list(rows)
+            counts = index.counts(row.id for row in rows)
+        else:
+            counts = index.counts(wanted)
+            if not lazy:
+                rows = list(rows)
+    return rows, counts
+
+
+def facet_links(selected, counts, **params):
+    links = []
+    for genre, label in genre_choices:
+        if genre in selected:
+            toggled = [g for g in selected if g != genre]
+        else:
+            toggled = selected + [genre]
+        links.append({
+            "genre": label,
+            "count": counts.get(genre, 0),
+            "selected": genre in selected,
+            "url": url_for(request.endpoint, genre=toggled, **params),
+        })
+    return links
+
+
+#----------------------------------------------------------------------------#
+# Geolocation.
+#----------------------------------------------------------------------------#
+
+# Venues are geocoded to their city centroid from a bundled gazetteer, so no
+# network service is involved. Radius and nearest-neighbour searches scan
+# only the geohash cells around the centre through the prefix index.
+
+gazetteer = geo.Gazetteer(app.config['GAZETTEER_PATH'])
+
+
+def coordinates(city, state):
+    place = gazetteer.lookup(city, state)
+    return {
+        "latitude": place[0] if place else None,
+        "longitude": place[1] if place else None,
+        "geohash": geo.encode(*place) if place else None,
+    }
+
+
+def geocode(venue):
+    for column, value in coordinates(venue.city, venue.state).items():
+        setattr(venue, column, value)
+    return venue.geohash is not None
+
+
+def venues_in_cells(lat, lon, prefixes):
+    query = db.session.query(Venue.id, Venue.name, Venue.city, Venue.state,
+                             Venue.latitude, Venue.longitude)
+    query = query.filter(
+        db.or_(*[Venue.geohash.like(prefix + '%') for prefix in prefixes]))
+    found = []
+    for row in query:
+        distance = geo.haversine(lat, lon, row.latitude, row.longitude)
+        found.append((distance, row))
+    found.sort(key=lambda pair: pair[0])
+    return found
+
+
+def venues_within(lat, lon, radius):
+    found = venues_in_cells(lat, lon, geo.cover(lat, lon, radius))
+    return [pair for pair in found if pair[0] <= radius]
+
+
+def nearest_venues(lat, lon, k):
+    # widen the neighbourhood until it provably holds the k closest venues
+    for precision in range(geo.PRECISION - 2, 0, -1):
+        found = venues_in_cells(lat, lon,
+                                geo.neighbourhood(lat, lon, precision))
+        reach = geo.reach(lat, precision)
+        if sum(1 for pair in found if pair[0] <= reach) >= k:
+            return found[:k]
+    return venues_in_cells(lat, lon, [''])[:k]
+
+
+@app.cli.command('geocode')
+def geocode_venues():
+    """Fill in coordinates for venues that have none."""
+    located = missing = 0
+    for venue in Venue.query.filter(Venue.geohash.is_(None)).yield_per(1000):
+        if geocode(venue):
+            located += 1
+        else:
+            missing += 1
+    db.session.commit()
+    print(f'Geocoded {located} venues, {missing} not found in gazetteer.')
+
+
+#----------------------------------------------------------------------------#
+# Matchmaking.
+#----------------------------------------------------------------------------#
+
+# Loaded once from column projections and a grouped booking count, then kept
+# current by the write handlers so recommendations never hit the database.
+
+matchmaker = Matchmaker([genre for genre, _ in genre_choices])
+
+
+def load_matchmaker(force=False):
+    if force or not matchmaker.built:
+        matchmaker.rebuild(
+            db.session.query(Venue.id, Venue.genres, Venue.city, Venue.state,
+                             Venue.seeking_talent),
+            db.session.query(Artist.id, Artist.genres, Artist.city,
+                             Artist.state, Artist.seeking_venue),
+            db.session.query(Show.artist_id, Show.venue_id, db.func.count())
+            .group_by(Show.artist_id, Show.venue_id))
+    return matchmaker
+
+
+def recommendations(model, ranked):
+    scores = dict(ranked)
+    rows = db.session.query(model.id, model.name, model.city, model.state) \
+        .filter(model.id.in_(list(scores))).all()
+    data = [{
+        "id": row.id,
+        "name": row.name,
+        "city": row.city,
+        "state": row.state,
+        "score": round(scores[row.id], 4),
+    } for row in rows]
+    data.sort(key=lambda match: -match["score"])
+    return jsonify({'success': True, 'count': len(data), 'data': data})
+
+
+#----------------------------------------------------------------------------#
+# Autocomplete.
+#----------------------------------------------------------------------------#
+
+# Names live in an in-memory prefix index built at startup and kept current
+# by the write handlers, so typeahead lookups never touch the database.
+
+name_index = PrefixIndex()
+
+
+def load_name_index(force=False):
+    if force or not name_index.built:
+        venues = db.session.query(db.literal('venue'), Venue.id, Venue.name)
+        artists = db.session.query(db.literal('artist'), Artist.id, Artist.name)
+        name_index.rebuild(itertools.chain(venues, artists))
+    return name_index
+
+
+#----------------------------------------------------------------------------#
+# Duplicate detection.
+#----------------------------------------------------------------------------#
+
+# New names are checked against a MinHash index blocked by city and state,
+# so the check costs the same at any catalog size.
+
+duplicates = DuplicateIndex(app.config['DEDUPE_THRESHOLD'])
+
+
+def load_duplicates(force=False):
+    if force or not duplicates.built:
+        venues = db.session.query(db.literal('venue'), Venue.id, Venue.name,
+                                  Venue.city, Venue.state).yield_per(10000)
+        artists = db.session.query(db.literal('artist'), Artist.id,
+                                   Artist.name, Artist.city,
+                                   Artist.state).yield_per(10000)
+        duplicates.rebuild(itertools.chain(venues, artists))
+    return duplicates
+
+
+def possible_duplicates(kind, data):
+    """Likely duplicates of a submitted name, unless the user confirmed it."""
+    if data.get('confirm_duplicate'):
+        return []
+    return [
+        {"id": entity_id, "name": name, "similarity": round(score, 2)}
+        for entity_id, name, score in load_duplicates().candidates(
+            kind, data.get('name', ''), data.get('city', ''),
+            data.get('state', ''))
+    ]
+
+
+@app.cli.command('dedupe-report')
+@click.option('--kind', type=click.Choice(['venue', 'artist', 'all']),
+              default='all')
+@click.option('--threshold', type=float, default=None,
+              help='Minimum name similarity (defaults to DEDUPE_THRESHOLD).')
+@click.option('--output', type=click.File('w'), default='-',
+              help='CSV file to write (defaults to stdout).')
+def dedupe_report(kind, threshold, output):
+    """List likely duplicate venues and artists as CSV."""
+    import csv
+    if threshold is not None:
+        duplicates.threshold = threshold
+    load_duplicates(force=True)
+    writer = csv.writer(output)
+    writer.writerow(['kind', 'id', 'name', 'duplicate_id', 'duplicate_name',
+                     'city', 'state', 'similarity'])
+    found = 0
+    for each in ('venue', 'artist') if kind == 'all' else (kind,):
+        for first, second, score in duplicates.pairs(each):
+            name, city, state = duplicates.entry(each, first)
+            writer.writerow([each, first, name, second,
+                             duplicates.entry(each, second)[0],
+                             city, state, '%.2f' % score])
+            found += 1
+    click.echo(f'{found} possible duplicate pairs.', err=True)
+
+
+#----------------------------------------------------------------------------#
+# Jobs.
+#----------------------------------------------------------------------------#
+
+# Heavy writes run on a worker pool outside the request. Jobs are stored in
+# a local SQLite table so they survive restarts and are retried on failure.
+
+jobs = JobQueue(app.config['JOBS_DATABASE'], context=app.app_context,
+                workers=app.config['JOB_WORKERS'],
+                lease=app.config['JOB_LEASE'])
+
+
+@app.before_request
+def start_jobs():
+    # Serving workers start their pool on their first request, after any
+    # fork. CLI commands, benchmarks and test clients leave JOBS_AUTOSTART
+    # off, and `flask snapshot` marks its renders as internal, so they never
+    # claim a job they might abandon.
+    if app.config['JOBS_AUTOSTART'] and not request.environ.get(INTERNAL):
+        jobs.start()
+
+
+def delete_shows(criterion, batch_size=1000):
+    # many short transactions, so the cascade never holds locks for long
+    while True:
+        ids = [show_id for show_id, in
+               db.session.query(Show.id).filter(criterion).limit(batch_size)]
+        if not ids:
+            break
+        Show.query.filter(Show.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+@jobs.handler('delete_venue')
+def delete_venue_job(venue_id):
+    # the artist pages listing these shows change too
+    for artist_id, in db.session.query(Show.artist_id) \
+            .filter(Show.venue_id == venue_id).distinct():
+        record_change(venue_id=venue_id, artist_id=artist_id)
+    record_change(venue_id=venue_id)
+    db.session.commit()
+    delete_shows(Show.venue_id == venue_id)
+    delete_residencies(Residency.venue_id == venue_id)
+    Venue.query.filter_by(id=venue_id).delete()
+    db.session.commit()
+    venue_genres.discard(venue_id)
+    venue_cache.invalidate(venue_id)
+    name_index.discard('venue', venue_id)
+    duplicates.discard('venue', venue_id)
+    matchmaker.discard_venue(venue_id)
+
+
+@jobs.handler('delete_artist')
+def delete_artist_job(artist_id):
+    # the venue pages listing these shows change too
+    for venue_id, in db.session.query(Show.venue_id) \
+            .filter(Show.artist_id == artist_id).distinct():
+        record_change(venue_id=venue_id, artist_id=artist_id)
+    record_change(artist_id=artist_id)
+    db.session.commit()
+    delete_shows(Show.artist_id == artist_id)
+    delete_residencies(Residency.artist_id == artist_id)
+    Artist.query.filter_by(id=artist_id).delete()
+    db.session.commit()
+    artist_genres.discard(artist_id)
+    artist_cache.invalidate(artist_id)
+    name_index.discard('artist', artist_id)
+    duplicates.discard('artist', artist_id)
+    matchmaker.discard_artist(artist_id)
+
+
+@jobs.handler('reindex')
+def reindex_job():
+    # also recounts the per-entity show totals held by the matchmaker
+    venue_genres.rebuild(db.session.query(Venue.id, Venue.genres))
+    artist_genres.rebuild(db.session.query(Artist.id, Artist.genres))
+    load_name_index(force=True)
+    load_duplicates(force=True)
+    load_matchmaker(force=True)
+    venue_cache.clear()
+    artist_cache.clear()
+
+
+#----------------------------------------------------------------------------#
+# Change sync.
+#----------------------------------------------------------------------------#
+
+# Each worker keeps its own identity cache and indexes and updates them with
+# its own writes. Writes made by other workers and by jobs reach it through
+# the Change table: at most every CHANGE_POLL seconds a request first applies
+# the rows added since, reloading each changed venue or artist (or dropping
+# it once deleted) and recounting changed bookings. Applying a row twice is
+# harmless, so rows younger than CHANGE_SETTLE seconds are read again until
+# any transaction that took a lower id has committed.
+
+changes_lock = threading.Lock()
+changes_seen = None
+changes_checked_at = 0.0
+
+
+@app.before_request
+def sync_changes():
+    global changes_seen, changes_checked_at
+    now = time.monotonic()
+    if now - changes_checked_at < app.config['CHANGE_POLL'] or \
+            not changes_lock.acquire(blocking=False):
+        return
+    try:
+        changes_checked_at = now
+        settled = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=app.config['CHANGE_SETTLE'])
+        if changes_seen is None:
+            # a fresh worker builds everything from the tables themselves
+            changes_seen = db.session.query(db.func.max(Change.id)) \
+                .filter(Change.changed_at < settled).scalar() or 0
+            return
+        rows = db.session.query(Change.id, Change.venue_id, Change.artist_id,
+                                Change.changed_at) \
+            .filter(Change.id > changes_seen).order_by(Change.id).all()
+        apply_changes(rows)
+        changes_seen = max([row.id for row in rows if row.changed_at < settled],
+                           default=changes_seen)
+    finally:
+        changes_lock.release()
+
+
+def apply_changes(rows):
+    venue_ids = {row.venue_id for row in rows if row.artist_id is None}
+    artist_ids = {row.artist_id for row in rows if row.venue_id is None}
+    pairs = {(row.artist_id, row.venue_id) for row in rows
+             if row.venue_id is not None and row.artist_id is not None}
+    for venue_id in venue_ids:
+        venue_cache.invalidate(venue_id)
+    for artist_id in artist_ids:
+        artist_cache.invalidate(artist_id)
+
+    found = set()
+    for venue in db.session.query(
+            Venue.id, Venue.name, Venue.genres, Venue.city, Venue.state,
+            Venue.seeking_talent).filter(Venue.id.in_(venue_ids)):
+        found.add(venue.id)
+        venue_genres.update(venue.id, venue.genres)
+        name_index.add('venue', venue.id, venue.name)
+        duplicates.add('venue', venue.id, venue.name, venue.city, venue.state)
+        matchmaker.update_venue(venue.id, venue.genres, venue.city,
+                                venue.state, venue.seeking_talent)
+    for venue_id in venue_ids - found:
+        venue_genres.discard(venue_id)
+        name_index.discard('venue', venue_id)
+        duplicates.discard('venue', venue_id)
+        matchmaker.discard_venue(venue_id)
+
+    found = set()
+    for artist in db.session.query(
+            Artist.id, Artist.name, Artist.genres, Artist.city, Artist.state,
+            Artist.seeking_venue).filter(Artist.id.in_(artist_ids)):
+        found.add(artist.id)
+        artist_genres.update(artist.id, artist.genres)
+        name_index.add('artist', artist.id, artist.name)
+        duplicates.add('artist', artist.id, artist.name, artist.city,
+                       artist.state)
+        matchmaker.update_artist(artist.id, artist.genres, artist.city,
+                                 artist.state, artist.seeking_venue)
+    for artist_id in artist_ids - found:
+        artist_genres.discard(artist_id)
+        name_index.discard('artist', artist_id)
+        duplicates.discard('artist', artist_id)
+        matchmaker.discard_artist(artist_id)
+
+    if pairs and matchmaker.built:
+        counts = dict.fromkeys(pairs, 0)
+        for artist_id in {artist_id for artist_id, _ in pairs}:
+            for venue_id, count in db.session.query(
+                    Show.venue_id, db.func.count()) \
+                    .filter(Show.artist_id == artist_id) \
+                    .group_by(Show.venue_id):
+                if (artist_id, venue_id) in counts:
+                    counts[artist_id, venue_id] = count
+        for (artist_id, venue_id), count in counts.items():
+            matchmaker.set_shows(artist_id, venue_id, count)
+
+
+#----------------------------------------------------------------------------#
+# Show feed.
+#----------------------------------------------------------------------------#
+
+# New shows are written to the FeedEvent table together with the shows
+# themselves. Each worker follows the table on one thread and pushes new
+# rows to its /shows/feed subscribers, so a show listed on any worker
+# reaches all of them. Subscribers never query the database.
+
+show_feed = Broadcaster(history=app.config['FEED_HISTORY'],
+                        max_subscribers=app.config['FEED_MAX_SUBSCRIBERS'])
+feed_pruned_at = 0.0
+
+
+def show_event(venue, artist, start_time):
+    if isinstance(start_time, datetime.datetime):
+        start_time = start_time.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return FeedEvent(payload=json.dumps({
+        "venue_id": venue.id,
+        "venue_name": venue.name,
+        "artist_id": artist.id,
+        "artist_name": artist.name,
+        "artist_image_link": artist.image_link,
+        "start_time": str(start_time),
+        "genres": sorted(set(venue.genres or ()) | set(artist.genres or ())),
+    }))
+
+
+def feed_events(after, batch_size=500):
+    """(id, event) pairs after ``after``, or the most recent ones for None."""
+    global feed_pruned_at
+    with app.app_context():
+        try:
+            if time.monotonic() - feed_pruned_at > 3600:
+                feed_pruned_at = time.monotonic()
+                FeedEvent.query.filter(
+                    FeedEvent.created_at < datetime.datetime.utcnow()
+                    - datetime.timedelta(days=app.config['FEED_RETENTION'])
+                ).delete(synchronize_session=False)
+                db.session.commit()
+            query = db.session.query(FeedEvent.id, FeedEvent.payload)
+            if after is None:
+                rows = query.order_by(FeedEvent.id.desc()) \
+                    .limit(app.config['FEED_HISTORY']).all()[::-1]
+            else:
+                rows = query.filter(FeedEvent.id > after) \
+                    .order_by(FeedEvent.id).limit(batch_size).all()
+            return [(event_id, json.loads(payload))
+                    for event_id, payload in rows]
+        finally:
+            db.session.close()
+
+
+#----------------------------------------------------------------------------#
+# Residencies.
+#----------------------------------------------------------------------------#
+
+# Residency occurrences are never stored. Pages expand the rules within
+# their window and merge the result into the Show rows by start time.
+
+Occurrence = namedtuple(
+    'Occurrence', 'venue_id artist_id start_time residency_id occurs_at')
+
+
+def residency_rule(residency):
+    return recurrence.Rule(residency.starts_at, residency.frequency,
+                           residency.interval, residency.until,
+                           residency.count)
+
+
+def residency_shows(start, end, *criteria):
+    """Occurrences in ``[start, end)`` of the matching residencies, in order."""
+    # ended residencies only count for occurrences moved past their end
+    moved_here = db.select(ResidencyException.residency_id).where(
+        ResidencyException.moved_to >= start)
+    residencies = Residency.query.filter(
+        Residency.starts_at < end,
+        db.or_(Residency.until.is_(None), Residency.until >= start,
+               Residency.id.in_(moved_here)),
+        *criteria).all()
+    if not residencies:
+        return iter(())
+    exceptions = {residency.id: {} for residency in residencies}
+    for residency_id, occurs_at, moved_to in db.session.query(
+            ResidencyException.residency_id, ResidencyException.occurs_at,
+            ResidencyException.moved_to).filter(
+            ResidencyException.residency_id.in_(exceptions)):
+        exceptions[residency_id][occurs_at] = moved_to
+    expansions = [expand_residency(residency, exceptions[residency.id],
+                                   start, end)
+                  for residency in residencies]
+    return heapq.merge(*expansions, key=lambda show: show.start_time)
+
+
+def expand_residency(residency, exceptions, start, end):
+    for original, actual in recurrence.expand(
+            residency_rule(residency), exceptions, start, end):
+        yield Occurrence(residency.venue_id, residency.artist_id, actual,
+                         residency.id, original)
+
+
+def with_residencies(shows, start, end, *criteria):
+    # shows must already be ordered by start_time
+    return heapq.merge(shows, residency_shows(start, end, *criteria),
+                       key=lambda show: show.start_time)
+
+
+def delete_residencies(criterion):
+    ids = [residency_id for residency_id, in
+           db.session.query(Residency.id).filter(criterion)]
+    if ids:
+        ResidencyException.query.filter(
+            ResidencyException.residency_id.in_(ids)) \
+            .delete(synchronize_session=False)
+        Residency.query.filter(Residency.id.in_(ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+#----------------------------------------------------------------------------#
+# Static snapshots.
+#----------------------------------------------------------------------------#
+
+def snapshot_targets(state, full):
+    """Paths to render and to remove since the last run, plus the id of the
+    newest change they cover."""
+    latest = db.session.query(db.func.max(Change.id)).scalar() or 0
+    if full or 'last_change' not in state:
+        venue_ids = {i for i, in db.session.query(Venue.id)}
+        artist_ids = {i for i, in db.session.query(Artist.id)}
+        return (['/venues', '/artists'] +
+                [f'/venues/{i}' for i in sorted(venue_ids)] +
+                [f'/artists/{i}' for i in sorted(artist_ids)], [], latest)
+
+    changes = db.session.query(Change.venue_id, Change.artist_id) \
+        .filter(Change.id > state['last_change'], Change.id <= latest) \
+        .distinct().all()
+    venue_ids = {v for v, a in changes if v is not None}
+    artist_ids = {a for v, a in changes if a is not None}
+    changed_venues = {v for v, a in changes if a is None and v is not None}
+    changed_artists = {a for v, a in changes if v is None and a is not None}
+    if changed_venues:
+        artist_ids.update(a for a, in db.session.query(Show.artist_id)
+                          .filter(Show.venue_id.in_(changed_venues)).distinct())
+    if changed_artists:
+        venue_ids.update(v for v, in db.session.query(Show.venue_id)
+                         .filter(Show.artist_id.in_(changed_artists)).distinct())
+
+    live_venues = {i for i, in db.session.query(Venue.id)
+                   .filter(Venue.id.in_(venue_ids))} if venue_ids else set()
+    live_artists = {i for i, in db.session.query(Artist.id)
+                    .filter(Artist.id.in_(artist_ids))} if artist_ids else set()
+    render = ((['/venues'] if changed_venues else []) +
+              (['/artists'] if changed_artists else []) +
+              [f'/venues/{i}' for i in sorted(live_venues)] +
+              [f'/artists/{i}' for i in sorted(live_artists)])
+    removed = ([f'/venues/{i}' for i in sorted(venue_ids - live_venues)] +
+               [f'/artists/{i}' for i in sorted(artist_ids - live_artists)])
+    return render, removed, latest
+
+
+def prune_changes(upto, batch_size=10000):
+    """Delete the Change rows a snapshot covered, up to id ``upto``.
+
+    Rows from the last CHANGE_RETENTION days stay, since calendar
+    validators and the workers' change sync still read them.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        days=app.config['CHANGE_RETENTION'])
+    pruned = 0
+    # many short transactions, like delete_shows
+    while True:
+        ids = [change_id for change_id, in db.session.query(Change.id)
+               .filter(Change.id <= upto, Change.changed_at < cutoff)
+               .limit(batch_size)]
+        if not ids:
+            break
+        Change.query.filter(Change.id.in_(ids)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        pruned += len(ids)
+    return pruned
+
+
+@app.cli.command('snapshot')
+@click.option('--output', default=lambda: app.config['SNAPSHOT_DIR'],
+              help='Directory to write the static site to.')
+@click.option('--full', is_flag=True,
+              help='Re-render every page instead of only changed ones.')
+@click.option('--workers', type=int, default=None,
+              help='Render processes (defaults to the CPU count).')
+def snapshot_pages(output, full, workers):
+    """Pre-render the venue and artist pages to static HTML."""
+    state = snapshot.load_state(output)
+    paths, removed, latest = snapshot_targets(state, full)
+    db.session.close()
+    db.engine.dispose()
+    if full or 'last_change' not in state:
+        snapshot.copy_static(app, output)
+
+    written, failed = snapshot.render(app, paths, output, workers)
+    snapshot.remove(output, removed)
+    if not failed:
+        snapshot.save_state(output, {
+            'last_change': latest,
+            'rendered_at': datetime.datetime.utcnow().isoformat(),
+        })
+    print(f'Rendered {len(written)} pages, removed {len(removed)}, '
+          f'{len(failed)} failed.')
+    for path in failed:
+        print(f'  failed: {path}')
+    if not failed:
+        print(f'Pruned {prune_changes(latest)} change log rows.')
+
+
+#----------------------------------------------------------------------------#
+# Templates.
+#----------------------------------------------------------------------------#
+
+@app.cli.command('precompile-templates')
+def precompile_templates():
+    """Compile every template into the on-disk bytecode cache."""
+    if app.jinja_env.bytecode_cache is None:
+        app.jinja_env.bytecode_cache = template_cache()
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    print(f"Compiled {len(names)} templates into {app.config['TEMPLATE_CACHE_DIR']}.")
+
+
 #----------------------------------------------------------------------------#
 # Filters.
 #----------------------------------------------------------------------------#
 
 def format_datetime(value, format='medium'):
+    # dateutil is only needed here, so it loads on first use (babel is
+    # usually loaded already, by Flask-WTF through Flask-Babel)
+    import babel.dates
+    import dateutil.parser
     date = dateutil.parser.parse(value)
     if format == 'full':
         format = "EEEE MMMM, d, y 'at' h:mma"
@@ -139,89 +1069,94 @@ def index():
     return render_template('pages/home.html')
 
 
+@app.route('/autocomplete')
+def autocomplete():
+    kind = request.args.get('kind')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    data = []
+    for entry_kind, entity_id, name in load_name_index().search(
+            request.args.get('q', ''), kind, limit):
+        if entry_kind == 'venue':
+            url = url_for('show_venue', venue_id=entity_id)
+        else:
+            url = url_for('show_artist', artist_id=entity_id)
+        data.append({"kind": entry_kind, "id": entity_id,
+                     "name": name, "url": url})
+    return jsonify({'success': True, 'data': data})
+
+
 #  Venues
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
 def venues():
-    data = []
-    exist = []
-    venues = Venue.query.order_by(Venue.state).order_by(
-        Venue.city).order_by(Venue.name).all()
-
-    for venue in venues:
-        details = {}
-        details["id"] = venue.id
-        details["name"] = venue.name
-        new_venue = {}
-        new_venue["city"] = venue.city
-        new_venue["state"] = venue.state
-        new_venue["venues"] = [details]
-
-        if (venue.city, venue.state) not in exist:
-            data.append(new_venue)
-            exist.append((venue.city, venue.state))
-        else:
-            for d in data:
-                if d["city"] == venue.city and d["state"] == venue.state:
-                    d["venues"].append(details)
-                    break
-
-    return render_template('pages/venues.html', areas=data)
+    selected = request.args.getlist('genre')
+    rows, counts = faceted(Venue, venue_genres, venue_summaries, selected,
+                           lazy=True)
+    data = group_by_area(rows)
+    return stream_page('pages/venues.html', areas=data,
+                       facets=facet_links(selected, counts))
 
 
-@app.route('/venues/search', methods=['POST'])
+@app.route('/venues/search', methods=['GET', 'POST'])
 def search_venues():
-    word = "%{}%".format(request.form.get('search_term'))
-    venues = Venue.query.filter(Venue.name.ilike(word)).all()
-    data = []
-
-    for venue in venues:
-        current = {}
-        current["id"] = venue.id
-        current["name"] = venue.name
-
-        data.append(current)
+    search_term = request.values.get('search_term', '')
+    selected = request.values.getlist('genre')
+    word = "%{}%".format(search_term)
+    data, counts = faceted(Venue, venue_genres, venue_summaries, selected,
+                           Venue.name.ilike(word))
 
     response = {
         "count": len(data),
         "data": data
     }
-    return render_template('pages/search_venues.html', results=response, search_term=request.form.get('search_term', ''))
+    return render_template('pages/search_venues.html', results=response, search_term=search_term,
+                           facets=facet_links(selected, counts, search_term=search_term))
 
 
 @app.route('/venues/<int:venue_id>')
 def show_venue(venue_id):
     error = False
+    venue = None
 
     try:
-        venue = Venue.query.get(venue_id)
-        shows = venue.shows
+        venue = get_venue(venue_id)
+        now = datetime.datetime.now()
+        window = datetime.timedelta(days=app.config['RESIDENCY_WINDOW'])
+        shows = db.session.query(Show.artist_id, Show.start_time) \
+            .filter(Show.venue_id == venue_id).order_by(Show.start_time)
+        shows = list(with_residencies(shows, now - window, now + window,
+                                      Residency.venue_id == venue_id))
+        artists = get_artists(show.artist_id for show in shows)
         future_shows = []
         past_shows = []
 
         for show in shows:
             future_show = {}
             past_show = {}
+            artist = artists.get(show.artist_id)
+            if artist is None:
+                continue
 
             if datetime.datetime.now() < show.start_time:
                 # future
                 future_show['artist_id'] = show.artist_id
-                future_show['artist_name'] = Artist.query.get(
-                    show.artist_id).name
-                future_show['artist_image_link'] = Artist.query.get(
-                    show.artist_id).image_link
+                future_show['artist_name'] = artist.name
+                future_show['artist_image_link'] = artist.image_link
                 future_show['start_time'] = show.start_time.strftime(
                     "%Y-%m-%d %H:%M:%S.%f")
+                future_show['residency_id'] = getattr(
+                    show, 'residency_id', None)
                 future_shows.append(future_show)
             elif datetime.datetime.now() >= show.start_time:
                 # past
-                past_show['artist_id'] = show.venue_id
-                past_show['artist_name'] = Artist.query.get(show.venue_id).name
-                past_show['artist_image_link'] = Artist.query.get(
-                    show.venue_id).image_link
+                past_show['artist_id'] = show.artist_id
+                past_show['artist_name'] = artist.name
+                past_show['artist_image_link'] = artist.image_link
                 past_show['start_time'] = show.start_time.strftime(
                     "%Y-%m-%d %H:%M:%S.%f")
+                past_show['residency_id'] = getattr(
+                    show, 'residency_id', None)
                 past_shows.append(past_show)
 
         data = {
@@ -258,6 +1193,60 @@ def show_venue(venue_id):
         return redirect(url_for('index'))
 
 
+@app.route('/venues/near')
+def venues_near():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        place = gazetteer.lookup(request.args.get('city'),
+                                 request.args.get('state'))
+        if place is None:
+            return jsonify({
+                'success': False,
+                'message': 'Give lat and lon, or a known city and state.'
+            }), 400
+        lat, lon = place
+
+    k = request.args.get('k', type=int)
+    radius = request.args.get('radius', type=float)
+    # an unparsable value comes back as None, so it is rejected here too
+    if 'k' in request.args and not (k and 0 < k <= app.config['NEAR_MAX_K']):
+        return jsonify({
+            'success': False,
+            'message': 'k must be between 1 and %d.' % app.config['NEAR_MAX_K']
+        }), 400
+    if 'radius' not in request.args:
+        radius = 25.0
+    # also false for nan
+    if radius is None or not 0 < radius <= app.config['NEAR_MAX_RADIUS']:
+        return jsonify({
+            'success': False,
+            'message': 'radius must be above 0 and at most %g km.'
+            % app.config['NEAR_MAX_RADIUS']
+        }), 400
+    if k:
+        found = nearest_venues(lat, lon, k)
+    else:
+        found = venues_within(lat, lon, radius)
+
+    data = []
+    for distance, venue in found:
+        data.append({
+            "id": venue.id,
+            "name": venue.name,
+            "city": venue.city,
+            "state": venue.state,
+            "distance_km": round(distance, 2),
+        })
+    return jsonify({'success': True, 'count': len(data), 'data': data})
+
+
+@app.route('/venues/<int:venue_id>/recommendations')
+def recommend_artists(venue_id):
+    k = request.args.get('k', 10, type=int)
+    return recommendations(Artist, load_matchmaker().artists_for(venue_id, k))
+
+
 #  Create Venue
 #  ----------------------------------------------------------------
 
@@ -282,6 +1271,11 @@ def create_venue_submission():
               data['name'] + ' could not be listed.')
         return render_template('forms/new_venue.html', form=form)
 
+    similar = possible_duplicates('venue', data)
+    if similar:
+        return render_template('forms/new_venue.html', form=form,
+                               duplicates=similar, kind='venue')
+
     try:
         venue = Venue(
             name=data['name'],
@@ -296,8 +1290,16 @@ def create_venue_submission():
             seeking_talent=s_talent,
             seeking_description=data['seeking_description']
         )
+        geocode(venue)
         db.session.add(venue)
+        db.session.flush()
+        record_change(venue_id=venue.id)
         db.session.commit()
+        venue_genres.update(venue.id, venue.genres)
+        name_index.add('venue', venue.id, venue.name)
+        duplicates.add('venue', venue.id, venue.name, venue.city, venue.state)
+        matchmaker.update_venue(venue.id, venue.genres, venue.city,
+                                venue.state, venue.seeking_talent)
     except:
         error = True
         db.session.rollback()
@@ -319,17 +1321,15 @@ def create_venue_submission():
 def delete_venue(venue_id):
     error = False
     try:
-        Venue.query.filter_by(id=venue_id).delete()
-        db.session.commit()
+        job_id = jobs.enqueue('delete_venue', venue_id=int(venue_id))
     except:
         error = True
-        db.session.rollback()
-    finally:
-        db.session.close()
+        print(sys.exc_info())
 
     if not error:
-        flash('Venue was successfully deleted!')
-        return jsonify({'success': True})
+        flash('Venue is being deleted.')
+        return jsonify({'success': True,
+                        'job': url_for('job_status', job_id=job_id)}), 202
     else:
         flash('An error occurred. Venue could not be deleted.')
         return redirect(url_for('index'))
@@ -339,71 +1339,73 @@ def delete_venue(venue_id):
 #  ----------------------------------------------------------------
 @app.route('/artists')
 def artists():
-    data = []
-    artists = Artist.query.order_by(Artist.name).all()
-
-    for artist in artists:
-        add = {}
-        add["id"] = artist.id
-        add["name"] = artist.name
-
-        data.append(add)
-
-    return render_template('pages/artists.html', artists=data)
+    selected = request.args.getlist('genre')
+    data, counts = faceted(Artist, artist_genres, artist_summaries, selected,
+                           lazy=True)
+    return stream_page('pages/artists.html', artists=data,
+                       facets=facet_links(selected, counts))
 
 
-@app.route('/artists/search', methods=['POST'])
+@app.route('/artists/search', methods=['GET', 'POST'])
 def search_artists():
-    word = "%{}%".format(request.form.get('search_term'))
-    artists = Artist.query.filter(Artist.name.ilike(word)).all()
-    data = []
-
-    for artist in artists:
-        current = {}
-        current["id"] = artist.id
-        current["name"] = artist.name
-
-        data.append(current)
+    search_term = request.values.get('search_term', '')
+    selected = request.values.getlist('genre')
+    word = "%{}%".format(search_term)
+    data, counts = faceted(Artist, artist_genres, artist_summaries, selected,
+                           Artist.name.ilike(word))
 
     response = {
         "count": len(data),
         "data": data
     }
 
-    return render_template('pages/search_artists.html', results=response, search_term=request.form.get('search_term', ''))
+    return render_template('pages/search_artists.html', results=response, search_term=search_term,
+                           facets=facet_links(selected, counts, search_term=search_term))
 
 
 @app.route('/artists/<int:artist_id>')
 def show_artist(artist_id):
     error = False
+    artist = None
 
     try:
-        artist = Artist.query.get(artist_id)
-        shows = artist.shows
+        artist = get_artist(artist_id)
+        now = datetime.datetime.now()
+        window = datetime.timedelta(days=app.config['RESIDENCY_WINDOW'])
+        shows = db.session.query(Show.venue_id, Show.start_time) \
+            .filter(Show.artist_id == artist_id).order_by(Show.start_time)
+        shows = list(with_residencies(shows, now - window, now + window,
+                                      Residency.artist_id == artist_id))
+        venues = get_venues(show.venue_id for show in shows)
         future_shows = []
         past_shows = []
 
         for show in shows:
             future_show = {}
             past_show = {}
+            venue = venues.get(show.venue_id)
+            if venue is None:
+                continue
 
             if datetime.datetime.now() < show.start_time:
                 # future
                 future_show['venue_id'] = show.venue_id
-                future_show['venue_name'] = Venue.query.get(show.venue_id).name
-                future_show['venue_image_link'] = Venue.query.get(
-                    show.venue_id).image_link
+                future_show['venue_name'] = venue.name
+                future_show['venue_image_link'] = venue.image_link
                 future_show['start_time'] = show.start_time.strftime(
                     "%Y-%m-%d %H:%M:%S.%f")
+                future_show['residency_id'] = getattr(
+                    show, 'residency_id', None)
                 future_shows.append(future_show)
             elif datetime.datetime.now() >= show.start_time:
                 # past
                 past_show['venue_id'] = show.venue_id
-                past_show['venue_name'] = Venue.query.get(show.venue_id).name
-                past_show['venue_image_link'] = Venue.query.get(
-                    show.venue_id).image_link
+                past_show['venue_name'] = venue.name
+                past_show['venue_image_link'] = venue.image_link
                 past_show['start_time'] = show.start_time.strftime(
                     "%Y-%m-%d %H:%M:%S.%f")
+                past_show['residency_id'] = getattr(
+                    show, 'residency_id', None)
                 past_shows.append(past_show)
 
         data = {
@@ -439,12 +1441,27 @@ def show_artist(artist_id):
         return redirect(url_for('index'))
 
 
+@app.route('/artists/<int:artist_id>/recommendations')
+def recommend_venues(artist_id):
+    k = request.args.get('k', 10, type=int)
+    return recommendations(Venue, load_matchmaker().venues_for(artist_id, k))
+
+
 #  Update
 #  ----------------------------------------------------------------
 @app.route('/artists/<int:artist_id>/edit', methods=['GET'])
 def edit_artist(artist_id):
     form = ArtistForm()
-    data = Artist.query.get(artist_id)
+    # read past the snapshot cache: a stale version would make every save
+    # from this form fail as a conflict
+    data = db.session.query(
+        Artist.id, Artist.name, Artist.genres, Artist.city, Artist.state,
+        Artist.phone, Artist.website, Artist.facebook_link, Artist.image_link,
+        Artist.seeking_venue, Artist.seeking_description, Artist.version
+    ).filter(Artist.id == artist_id).first()
+    db.session.close()
+    if data is None:
+        abort(404)
 
     form.name.data = data.name
     form.genres.data = data.genres
@@ -455,6 +1472,7 @@ def edit_artist(artist_id):
     form.facebook_link.data = data.facebook_link
     form.seeking_description.data = data.seeking_description
     form.image_link.data = data.image_link
+    form.version.data = data.version
 
     if data.seeking_venue == 'true':
         s_venue = 'checked'
@@ -473,7 +1491,9 @@ def edit_artist(artist_id):
 @app.route('/artists/<int:artist_id>/edit', methods=['POST'])
 def edit_artist_submission(artist_id):
     error = False
+    conflict = False
     new = request.form
+    version = new.get('version', type=int)
 
     if 'seeking_venue' not in new:
         s_venue = ''
@@ -481,27 +1501,47 @@ def edit_artist_submission(artist_id):
         s_venue = True
 
     try:
-        current = Artist.query.get(artist_id)
-        current.name = new['name']
-        current.city = new['city']
-        current.state = new['state']
-        current.phone = new['phone']
-        current.genres = new.getlist('genres')
-        current.image_link = new['image_link']
-        current.facebook_link = new['facebook_link']
-        current.website = new['website']
-        current.seeking_venue = s_venue
-        current.seeking_description = new['seeking_description']
-
-        db.session.commit()
+        # one conditional UPDATE: it only matches if nobody saved in between
+        updated = Artist.query.filter_by(id=artist_id, version=version).update({
+            Artist.name: new['name'],
+            Artist.city: new['city'],
+            Artist.state: new['state'],
+            Artist.phone: new['phone'],
+            Artist.genres: new.getlist('genres'),
+            Artist.image_link: new['image_link'],
+            Artist.facebook_link: new['facebook_link'],
+            Artist.website: new['website'],
+            Artist.seeking_venue: s_venue,
+            Artist.seeking_description: new['seeking_description'],
+            Artist.version: Artist.version + 1,
+        }, synchronize_session=False)
+        if updated:
+            record_change(artist_id=artist_id)
+            db.session.commit()
+            artist_genres.update(artist_id, new.getlist('genres'))
+            name_index.add('artist', artist_id, new['name'])
+            duplicates.add('artist', artist_id, new['name'], new['city'],
+                           new['state'])
+            artist_cache.invalidate(artist_id)
+            matchmaker.update_artist(artist_id, new.getlist('genres'),
+                                     new['city'], new['state'], s_venue)
+        elif db.session.query(Artist.id).filter_by(id=artist_id).first():
+            conflict = True
+        else:
+            error = True
     except:
         error = True
         db.session.rollback()
         print(sys.exc_info())
     finally:
-        print("\n --------------UPDATED---------------\n", current)
         db.session.close()
 
+    if conflict:
+        flash('Artist ' + new['name'] + ' was changed by someone else while you were '
+              'editing. Review the latest details and submit again.')
+        artist_cache.invalidate(artist_id)
+        return edit_artist(artist_id), 409
+
     if not error:
         flash('Artist ' + new['name'] + ' was successfully updated!')
         return redirect(url_for('show_artist', artist_id=artist_id))
@@ -515,17 +1555,15 @@ def edit_artist_submission(artist_id):
 def delete_artist(artist_id):
     error = False
     try:
-        Artist.query.filter_by(id=artist_id).delete()
-        db.session.commit()
+        job_id = jobs.enqueue('delete_artist', artist_id=int(artist_id))
     except:
         error = True
-        db.session.rollback()
-    finally:
-        db.session.close()
+        print(sys.exc_info())
 
     if not error:
-        flash('Artist was successfully deleted!')
-        return jsonify({'success': True})
+        flash('Artist is being deleted.')
+        return jsonify({'success': True,
+                        'job': url_for('job_status', job_id=job_id)}), 202
     else:
         flash('An error occurred. Artist could not be deleted.')
         return redirect(url_for('index'))
@@ -534,7 +1572,15 @@ def delete_artist(artist_id):
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
     form = VenueForm()
-    data = Venue.query.get(venue_id)
+    # read past the snapshot cache, as in edit_artist
+    data = db.session.query(
+        Venue.id, Venue.name, Venue.genres, Venue.city, Venue.state, Venue.address,
+        Venue.phone, Venue.website, Venue.facebook_link, Venue.image_link,
+        Venue.seeking_talent, Venue.seeking_description, Venue.version
+    ).filter(Venue.id == venue_id).first()
+    db.session.close()
+    if data is None:
+        abort(404)
 
     form.name.data = data.name
     form.genres.data = data.genres
@@ -546,6 +1592,7 @@ def edit_venue(venue_id):
     form.facebook_link.data = data.facebook_link
     form.seeking_description.data = data.seeking_description
     form.image_link.data = data.image_link
+    form.version.data = data.version
 
     if data.seeking_talent == 'true':
         s_talent = 'checked'
@@ -564,7 +1611,9 @@ def edit_venue(venue_id):
 @app.route('/venues/<int:venue_id>/edit', methods=['POST'])
 def edit_venue_submission(venue_id):
     error = False
+    conflict = False
     new = request.form
+    version = new.get('version', type=int)
 
     if 'seeking_talent' not in new:
         s_talent = ''
@@ -572,28 +1621,49 @@ def edit_venue_submission(venue_id):
         s_talent = True
 
     try:
-        current = Venue.query.get(venue_id)
-        current.name = new['name']
-        current.city = new['city']
-        current.state = new['state']
-        current.address = new['address']
-        current.phone = new['phone']
-        current.genres = new.getlist('genres')
-        current.image_link = new['image_link']
-        current.facebook_link = new['facebook_link']
-        current.website = new['website']
-        current.seeking_talent = s_talent
-        current.seeking_description = new['seeking_description']
-
-        db.session.commit()
+        # one conditional UPDATE: it only matches if nobody saved in between
+        updated = Venue.query.filter_by(id=venue_id, version=version).update({
+            Venue.name: new['name'],
+            Venue.city: new['city'],
+            Venue.state: new['state'],
+            Venue.address: new['address'],
+            Venue.phone: new['phone'],
+            Venue.genres: new.getlist('genres'),
+            Venue.image_link: new['image_link'],
+            Venue.facebook_link: new['facebook_link'],
+            Venue.website: new['website'],
+            Venue.seeking_talent: s_talent,
+            Venue.seeking_description: new['seeking_description'],
+            Venue.version: Venue.version + 1,
+            **coordinates(new['city'], new['state']),
+        }, synchronize_session=False)
+        if updated:
+            record_change(venue_id=venue_id)
+            db.session.commit()
+            venue_genres.update(venue_id, new.getlist('genres'))
+            name_index.add('venue', venue_id, new['name'])
+            duplicates.add('venue', venue_id, new['name'], new['city'],
+                           new['state'])
+            venue_cache.invalidate(venue_id)
+            matchmaker.update_venue(venue_id, new.getlist('genres'),
+                                    new['city'], new['state'], s_talent)
+        elif db.session.query(Venue.id).filter_by(id=venue_id).first():
+            conflict = True
+        else:
+            error = True
     except:
         error = True
         db.session.rollback()
         print(sys.exc_info())
     finally:
-        print("\n --------------UPDATED---------------\n", current)
         db.session.close()
 
+    if conflict:
+        flash('Venue ' + new['name'] + ' was changed by someone else while you were '
+              'editing. Review the latest details and submit again.')
+        venue_cache.invalidate(venue_id)
+        return edit_venue(venue_id), 409
+
     if not error:
         flash('Venue ' + new['name'] + ' was successfully updated!')
         return redirect(url_for('show_venue', venue_id=venue_id))
@@ -627,6 +1697,11 @@ def create_artist_submission():
               data['name'] + ' could not be listed.')
         return render_template('forms/new_artist.html', form=form)
 
+    similar = possible_duplicates('artist', data)
+    if similar:
+        return render_template('forms/new_artist.html', form=form,
+                               duplicates=similar, kind='artist')
+
     try:
         artist = Artist(
             name=data['name'],
@@ -641,7 +1716,15 @@ def create_artist_submission():
             seeking_description=data['seeking_description']
         )
         db.session.add(artist)
+        db.session.flush()
+        record_change(artist_id=artist.id)
         db.session.commit()
+        artist_genres.update(artist.id, artist.genres)
+        name_index.add('artist', artist.id, artist.name)
+        duplicates.add('artist', artist.id, artist.name, artist.city,
+                       artist.state)
+        matchmaker.update_artist(artist.id, artist.genres, artist.city,
+                                 artist.state, artist.seeking_venue)
     except:
         error = True
         db.session.rollback()
@@ -662,27 +1745,84 @@ def create_artist_submission():
 #  Shows
 #  ----------------------------------------------------------------
 
-@app.route('/shows')
-def shows():
-    shows = Show.query.order_by(Show.start_time).all()
-    data = []
-    for show in shows:
-        future_show = {}
-        if datetime.datetime.now() < show.start_time:
+def upcoming_batches(since, venue_ids=None, artist_id=None, batch_size=500):
+    """(shows, venues, artists) for each batch of shows after ``since``.
+
+    Stored shows and residency occurrences come merged in time order, and
+    each batch's venues and artists are fetched together.
+    """
+    window = datetime.timedelta(days=app.config['RESIDENCY_WINDOW'])
+    criteria, residency_criteria = [Show.start_time > since], []
+    if venue_ids is not None:
+        criteria.append(Show.venue_id.in_(venue_ids))
+        residency_criteria.append(Residency.venue_id.in_(venue_ids))
+    if artist_id is not None:
+        criteria.append(Show.artist_id == artist_id)
+        residency_criteria.append(Residency.artist_id == artist_id)
+    shows = db.session.query(
+        Show.id, Show.venue_id, Show.artist_id, Show.start_time) \
+        .filter(*criteria).order_by(Show.start_time).yield_per(batch_size)
+    shows = with_residencies(shows, since, since + window, *residency_criteria)
+    for batch in iter(lambda: list(itertools.islice(shows, batch_size)), []):
+        yield (batch, get_venues(show.venue_id for show in batch),
+               get_artists(show.artist_id for show in batch))
+
+
+def upcoming_shows():
+    for batch, venues, artists in upcoming_batches(datetime.datetime.now()):
+        for show in batch:
+            future_show = {}
+            venue = venues.get(show.venue_id)
+            artist = artists.get(show.artist_id)
+            if venue is None or artist is None:
+                continue
             future_show['venue_id'] = show.venue_id
-            future_show['venue_name'] = Venue.query.get(show.venue_id).name
+            future_show['venue_name'] = venue.name
             future_show['artist_id'] = show.artist_id
-            future_show['artist_name'] = Artist.query.get(show.artist_id).name
-            future_show['artist_image_link'] = Artist.query.get(
-                show.artist_id).image_link
+            future_show['artist_name'] = artist.name
+            future_show['artist_image_link'] = artist.image_link
             future_show['start_time'] = show.start_time.strftime(
                 "%Y-%m-%d %H:%M:%S.%f")
+            future_show['residency_id'] = getattr(show, 'residency_id', None)
 
-            data.append(future_show)
+            yield future_show
 
-    if len(data) == 0:
+
+@app.route('/shows')
+def shows():
+    found, data = peek(upcoming_shows())
+
+    if not found:
         flash('There are currently no shows listed! Please bare with us.')
-    return render_template('pages/shows.html', shows=data)
+    return stream_page('pages/shows.html', shows=data)
+
+
+@app.route('/shows/feed')
+def show_feed_stream():
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+    subscription = Subscription(
+        venue_ids=request.args.getlist('venue', type=int),
+        artist_ids=request.args.getlist('artist', type=int),
+        genres=request.args.getlist('genre'),
+        maxsize=app.config['FEED_QUEUE_SIZE'])
+    show_feed.follow(feed_events, app.config['FEED_POLL'])
+    if show_feed.subscribe(subscription, last_event_id) is None:
+        return Response('Too many subscribers\n', 503, mimetype='text/plain',
+                        headers={'Retry-After': '30'})
+    # not wrapped in stream_with_context: an open feed holds no request
+    # context and no database session
+    stream = show_feed.stream(subscription, app.config['FEED_HEARTBEAT'])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route('/shows/feed/stats')
+def show_feed_stats():
+    return jsonify({'success': True, **show_feed.stats()})
 
 
 @app.route('/shows/create')
@@ -694,6 +1834,7 @@ def create_shows():
 @app.route('/shows/create', methods=['POST'])
 def create_show_submission():
     error = False
+    listed = None
     data = request.form
 
     try:
@@ -702,11 +1843,14 @@ def create_show_submission():
             venue_id=data['venue_id'],
             start_time=data['start_time']
         )
-        artist = Artist.query.get(show.artist_id)
-        venue = Venue.query.get(show.venue_id)
+        artist = get_artist(int(show.artist_id))
+        venue = get_venue(int(show.venue_id))
         if artist and venue:
             db.session.add(show)
+            db.session.add(show_event(venue, artist, show.start_time))
+            record_change(venue_id=venue.id, artist_id=artist.id)
             db.session.commit()
+            listed = (artist.id, venue.id)
         elif artist and not venue:
             flash('Venue not found! Check Venue ID on Venue\'s page.')
             error = True
@@ -726,6 +1870,10 @@ def create_show_submission():
         print("\n ----------------NEW----------------\n", show)
         db.session.close()
 
+    # the show is committed, so nothing here may report it as failed
+    if listed is not None:
+        matchmaker.add_show(*listed)
+
     if not error:
         flash('Show was successfully listed!')
         return render_template('pages/home.html')
@@ -733,6 +1881,420 @@ def create_show_submission():
         return redirect(url_for('create_shows'))
 
 
+def parse_tour(dates):
+    import dateutil.parser
+    rows = []
+    errors = []
+    seen = set()
+    for line, text in enumerate(dates.splitlines(), 1):
+        if not text.strip():
+            continue
+        venue_id, _, start_time = text.partition(',')
+        try:
+            row = (int(venue_id), dateutil.parser.parse(start_time.strip()))
+        except (ValueError, OverflowError):
+            errors.append({"line": line,
+                           "message": "expected 'Venue ID, YYYY-MM-DD HH:MM'"})
+            continue
+        if row in seen:
+            errors.append({"line": line, "message": "duplicate of an earlier line"})
+            continue
+        seen.add(row)
+        rows.append((line,) + row)
+    return rows, errors
+
+
+@app.route('/shows/create/batch')
+def create_tour():
+    form = TourForm()
+    return render_template('forms/new_tour.html', form=form)
+
+
+@app.route('/shows/create/batch', methods=['POST'])
+def create_tour_submission():
+    error = False
+    form = TourForm()
+    data = request.form
+
+    try:
+        artist_id = int(data.get('artist_id', ''))
+    except ValueError:
+        flash('Artist ID must be a number.')
+        return render_template('forms/new_tour.html', form=form)
+
+    rows, errors = parse_tour(data.get('dates', ''))
+
+    # every referenced id is checked in a single round trip
+    venue_ids = {venue_id for _, venue_id, _ in rows}
+    known = db.session.query(db.literal('artist'), Artist.id) \
+        .filter(Artist.id == artist_id) \
+        .union_all(db.session.query(db.literal('venue'), Venue.id)
+                   .filter(Venue.id.in_(venue_ids))).all()
+    known_venues = {entity_id for kind, entity_id in known if kind == 'venue'}
+    for line, venue_id, _ in rows:
+        if venue_id not in known_venues:
+            errors.append({"line": line,
+                           "message": f"venue {venue_id} not found"})
+
+    if ('artist', artist_id) not in known:
+        flash('Artist not found! Check Artist ID on Artist\'s page.')
+        error = True
+    elif not rows and not errors:
+        flash('Add at least one show date.')
+        error = True
+    if error or errors:
+        errors.sort(key=lambda e: e["line"])
+        db.session.close()
+        return render_template('forms/new_tour.html', form=form, errors=errors)
+
+    try:
+        artist = get_artist(artist_id)
+        venues = get_venues(venue_ids)
+        db.session.execute(Show.__table__.insert().values([
+            {"artist_id": artist_id, "venue_id": venue_id, "start_time": start_time}
+            for _, venue_id, start_time in rows
+        ]))
+        db.session.add_all(show_event(venues[venue_id], artist, start_time)
+                           for _, venue_id, start_time in rows)
+        for venue_id in venue_ids:
+            record_change(venue_id=venue_id, artist_id=artist_id)
+        db.session.commit()
+    except:
+        error = True
+        db.session.rollback()
+        print(sys.exc_info())
+    finally:
+        db.session.close()
+
+    # the shows are committed, so nothing here may report them as failed
+    if not error:
+        for _, venue_id, _ in rows:
+            matchmaker.add_show(artist_id, venue_id)
+
+    if not error:
+        flash(f'{len(rows)} shows were successfully listed!')
+        return render_template('pages/home.html')
+    else:
+        flash('An error occurred. Tour could not be listed.')
+        return redirect(url_for('create_tour'))
+
+
+def parse_residency(data):
+    """Residency from form data, or raise ValueError with the reason."""
+    import dateutil.parser
+    try:
+        artist_id = int(data.get('artist_id', ''))
+        venue_id = int(data.get('venue_id', ''))
+    except ValueError:
+        raise ValueError('Artist ID and Venue ID must be numbers.')
+    try:
+        starts_at = dateutil.parser.parse(data.get('starts_at', ''))
+        until = data.get('until', '').strip() or None
+        if until is not None:
+            until = dateutil.parser.parse(until)
+            if until.time() == datetime.time.min:
+                # a bare date includes shows on that day
+                until = datetime.datetime.combine(until, datetime.time.max)
+    except (ValueError, OverflowError):
+        raise ValueError('Dates must look like YYYY-MM-DD HH:MM.')
+    frequency = data.get('frequency', 'weekly')
+    if frequency not in recurrence.FREQUENCIES:
+        raise ValueError('Repeat daily, weekly or monthly.')
+    try:
+        interval = int(data.get('interval', '') or 1)
+        count = data.get('count', '').strip()
+        count = int(count) if count else None
+    except ValueError:
+        raise ValueError('Interval and number of shows must be numbers.')
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError('Interval and number of shows must be positive.')
+    if until is not None and count is not None:
+        raise ValueError('End the residency by date or by number of shows.')
+    return Residency(artist_id=artist_id, venue_id=venue_id,
+                     starts_at=starts_at, frequency=frequency,
+                     interval=interval, until=until, count=count)
+
+
+@app.route('/shows/create/residency')
+def create_residency():
+    form = ResidencyForm()
+    return render_template('forms/new_residency.html', form=form)
+
+
+@app.route('/shows/create/residency', methods=['POST'])
+def create_residency_submission():
+    error = False
+    form = ResidencyForm()
+    residency = None
+
+    try:
+        residency = parse_residency(request.form)
+        artist = get_artist(residency.artist_id)
+        venue = get_venue(residency.venue_id)
+        if artist and venue:
+            db.session.add(residency)
+            record_change(venue_id=venue.id, artist_id=artist.id)
+            db.session.commit()
+        else:
+            flash('Venue or Artist not found! Check Artist ID and Venue ID.')
+            error = True
+    except ValueError as reason:
+        error = True
+        flash(str(reason))
+    except:
+        error = True
+        db.session.rollback()
+        print(sys.exc_info())
+        flash('An error occurred. Residency could not be listed.')
+    finally:
+        print("\n ----------------NEW----------------\n", residency)
+        db.session.close()
+
+    if not error:
+        flash('Residency was successfully listed!')
+        return render_template('pages/home.html')
+    else:
+        return render_template('forms/new_residency.html', form=form)
+
+
+@app.route('/residencies/<int:residency_id>/occurrences')
+def residency_occurrences(residency_id):
+    import dateutil.parser
+    residency = db.session.get(Residency, residency_id)
+    if residency is None:
+        abort(404)
+    try:
+        start = dateutil.parser.parse(request.args['start']) \
+            if 'start' in request.args else datetime.datetime.now()
+        end = dateutil.parser.parse(request.args['end']) \
+            if 'end' in request.args else \
+            start + datetime.timedelta(days=app.config['RESIDENCY_WINDOW'])
+    except (ValueError, OverflowError):
+        abort(400)
+    if end - start > datetime.timedelta(days=app.config['RESIDENCY_MAX_WINDOW']):
+        abort(400)
+    exceptions = {exception.occurs_at: exception.moved_to
+                  for exception in residency.exceptions}
+    data = [
+        {"occurs_at": original.isoformat(), "start_time": actual.isoformat(),
+         "moved": original != actual}
+        for original, actual in recurrence.expand(
+            residency_rule(residency), exceptions, start, end)
+    ]
+    return jsonify({'success': True, 'data': data})
+
+
+@app.route('/residencies/<int:residency_id>/exceptions', methods=['POST'])
+def residency_exception(residency_id):
+    # occurs_at alone cancels that occurrence, with moved_to it moves it
+    import dateutil.parser
+    residency = db.session.get(Residency, residency_id)
+    if residency is None:
+        abort(404)
+    data = request.get_json(silent=True) or request.form
+    try:
+        occurs_at = dateutil.parser.parse(data.get('occurs_at', ''))
+        moved_to = data.get('moved_to') or None
+        if moved_to is not None:
+            moved_to = dateutil.parser.parse(moved_to)
+    except (ValueError, OverflowError):
+        return jsonify({'success': False,
+                        'message': 'Dates must look like YYYY-MM-DD HH:MM.'}), 400
+    if not recurrence.is_occurrence(residency_rule(residency), occurs_at):
+        return jsonify({'success': False,
+                        'message': 'No occurrence of this residency starts then.'}), 400
+
+    exception = ResidencyException.query.filter_by(
+        residency_id=residency_id, occurs_at=occurs_at).first()
+    if exception is None:
+        exception = ResidencyException(residency_id=residency_id,
+                                       occurs_at=occurs_at)
+        db.session.add(exception)
+    exception.moved_to = moved_to
+    record_change(venue_id=residency.venue_id, artist_id=residency.artist_id)
+    db.session.commit()
+    return jsonify({'success': True, 'cancelled': moved_to is None})
+
+
+@app.route('/residencies/<int:residency_id>', methods=['DELETE'])
+def delete_residency(residency_id):
+    residency = db.session.get(Residency, residency_id)
+    if residency is None:
+        abort(404)
+    record_change(venue_id=residency.venue_id, artist_id=residency.artist_id)
+    db.session.commit()
+    delete_residencies(Residency.id == residency_id)
+    return jsonify({'success': True})
+
+#  Calendars
+#  ----------------------------------------------------------------
+
+def calendar_day():
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+
+
+def performers(venue_ids, since):
+    """Artists with a show or residency at ``venue_ids`` from ``since`` on."""
+    return db.union(
+        db.select(Show.artist_id).where(Show.venue_id.in_(venue_ids),
+                                        Show.start_time >= since),
+        db.select(Residency.artist_id).where(
+            Residency.venue_id.in_(venue_ids),
+            db.or_(Residency.until.is_(None), Residency.until >= since)))
+
+
+def hosts(artist_id, since):
+    """Venues with a show or residency of ``artist_id`` from ``since`` on."""
+    return db.union(
+        db.select(Show.venue_id).where(Show.artist_id == artist_id,
+                                       Show.start_time >= since),
+        db.select(Residency.venue_id).where(
+            Residency.artist_id == artist_id,
+            db.or_(Residency.until.is_(None), Residency.until >= since)))
+
+
+def venue_changes(venue_ids):
+    # an artist's own changes only matter while they play one of the venues
+    return (Change.venue_id.in_(venue_ids),
+            db.and_(Change.venue_id.is_(None),
+                    Change.artist_id.in_(performers(venue_ids,
+                                                    calendar_day()))))
+
+
+def artist_changes(artist_id):
+    # a venue's own changes only matter while the artist plays there
+    return (Change.artist_id == artist_id,
+            db.and_(Change.artist_id.is_(None),
+                    Change.venue_id.in_(hosts(artist_id, calendar_day()))))
+
+
+def calendar_response(name, tag, changes, **shows):
+    """Streamed .ics of the upcoming shows, or 304 when the client is current.
+
+    The validators come from the last Change matching ``changes`` and from
+    today's date, since shows drop out of the feed as days pass. Nothing
+    else is queried for a 304.
+    """
+    today = calendar_day()
+    # shows are stored in local time, Change rows in UTC
+    midnight = today.astimezone(datetime.timezone.utc)
+    change_id, changed_at = db.session.query(Change.id, Change.changed_at) \
+        .filter(db.or_(*changes)).order_by(Change.id.desc()).first() \
+        or (0, None)
+    if changed_at is not None:
+        changed_at = changed_at.replace(tzinfo=datetime.timezone.utc)
+    last_modified = max(changed_at or midnight, midnight).replace(
+        microsecond=0)
+    etag = '%s-%d-%s' % (tag, change_id, today.strftime('%Y%m%d'))
+    headers = {
+        'ETag': '"%s"' % etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': 'public, max-age=%d' % app.config['CALENDAR_MAX_AGE'],
+    }
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+        db.session.close()
+        return Response(status=304, headers=headers)
+
+    host = request.host
+    base = request.host_url.rstrip('/')
+
+    def events():
+        for batch, venues, artists in upcoming_batches(today, **shows):
+            for show in batch:
+                venue = venues.get(show.venue_id)
+                artist = artists.get(show.artist_id)
+                if venue is None or artist is None:
+                    continue
+                if getattr(show, 'residency_id', None) is not None:
+                    uid = 'residency-%d-%s@%s' % (
+                        show.residency_id,
+                        show.occurs_at.strftime('%Y%m%dT%H%M%S'), host)
+                else:
+                    uid = 'show-%d@%s' % (show.id, host)
+                location = ', '.join(part for part in (
+                    venue.name, venue.address, venue.city, venue.state) if part)
+                yield ical.Event(uid, show.start_time,
+                                 f'{artist.name} at {venue.name}', location,
+                                 f'{base}/artists/{artist.id}')
+
+    duration = datetime.timedelta(minutes=app.config['CALENDAR_SHOW_LENGTH'])
+    body = ical.calendar(name, events(), last_modified, duration)
+    return Response(stream_with_context(body), mimetype='text/calendar',
+                    headers=headers)
+
+
+@app.route('/venues/<int:venue_id>/calendar.ics')
+def venue_calendar(venue_id):
+    venue = get_venue(venue_id)
+    if venue is None:
+        abort(404)
+    return calendar_response(
+        f'{venue.name} shows', f'v{venue_id}',
+        venue_changes([venue_id]), venue_ids=[venue_id])
+
+
+@app.route('/artists/<int:artist_id>/calendar.ics')
+def artist_calendar(artist_id):
+    artist = get_artist(artist_id)
+    if artist is None:
+        abort(404)
+    return calendar_response(
+        f'{artist.name} shows', f'a{artist_id}',
+        artist_changes(artist_id), artist_id=artist_id)
+
+
+@app.route('/cities/<state>/<city>/calendar.ics')
+def city_calendar(state, city):
+    venue_ids = db.select(Venue.id).where(Venue.city == city,
+                                          Venue.state == state)
+    tag = 'c%08x' % (zlib.crc32(f'{state}/{city}'.encode()))
+    return calendar_response(
+        f'Shows in {city}, {state}', tag,
+        venue_changes(venue_ids), venue_ids=venue_ids)
+
+
+#  Cache
+#  ----------------------------------------------------------------
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify({
+        'success': True,
+        'venues': venue_cache.stats(),
+        'artists': artist_cache.stats(),
+    })
+
+
+#  Jobs
+#  ----------------------------------------------------------------
+
+@app.route('/jobs')
+def job_list():
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    return jsonify({'success': True, 'data': jobs.recent(limit)})
+
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({'success': True, 'job': job})
+
+
+@app.route('/jobs/reindex', methods=['POST'])
+def reindex():
+    job_id = jobs.enqueue('reindex')
+    return jsonify({'success': True,
+                    'job': url_for('job_status', job_id=job_id)}), 202
+
+
+@app.route('/admission/stats')
+def admission_stats():
+    return jsonify({'success': True, **admission.stats})
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
@@ -760,6 +2322,10 @@ if not app.debug:
 
 # Default port:
 if __name__ == '__main__':
+    with app.app_context():
+        load_name_index()
+        load_duplicates()
+    jobs.start()
     app.run()
 
 # Or specify port manually:
@@ -0,0 +1,81 @@
+"""Sorted-array prefix index over venue and artist names.
+
+Every word position of a name is stored as a key in one sorted list, so a
+prefix lookup is a binary search followed by a short forward scan, and
+"fill" finds both "Fillmore" and "The Fillmore". Writes come from request
+handlers and job threads, so every read and write holds the index lock.
+"""
+import threading
+from bisect import bisect_left, insort
+
+
+def normalize(text):
+    return ' '.join((text or '').lower().split())
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.built = False
+        self._keys = []
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def rebuild(self, entries):
+        """Load (kind, id, name) rows."""
+        keys = []
+        names = {}
+        for kind, entity_id, name in entries:
+            names[(kind, entity_id)] = name
+            keys.extend(self._keys_for(kind, entity_id, name))
+        keys.sort()
+        with self._lock:
+            self._keys, self._entries = keys, names
+            self.built = True
+
+    def add(self, kind, entity_id, name):
+        with self._lock:
+            if not self.built:
+                return
+            self.discard(kind, entity_id)
+            self._entries[(kind, entity_id)] = name
+            for key in self._keys_for(kind, entity_id, name):
+                insort(self._keys, key)
+
+    def discard(self, kind, entity_id):
+        with self._lock:
+            name = self._entries.pop((kind, entity_id), None)
+            if name is None:
+                return
+            for key in self._keys_for(kind, entity_id, name):
+                position = bisect_left(self._keys, key)
+                if position < len(self._keys) and self._keys[position] == key:
+                    del self._keys[position]
+
+    def search(self, prefix, kind=None, limit=10):
+        """Up to ``limit`` (kind, id, name) matches, shortest names first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        found = {}
+        with self._lock:
+            keys, entries = self._keys, self._entries
+            position = bisect_left(keys, (prefix,))
+            while position < len(keys) and len(found) < limit:
+                key, entry_kind, entity_id = keys[position]
+                if not key.startswith(prefix):
+                    break
+                if kind in (None, entry_kind):
+                    found[(entry_kind, entity_id)] = \
+                        entries[(entry_kind, entity_id)]
+                position += 1
+        matches = [(entry_kind, entity_id, name)
+                   for (entry_kind, entity_id), name in found.items()]
+        matches.sort(key=lambda match: (len(match[2]), match[2]))
+        return matches
+
+    @staticmethod
+    def _keys_for(kind, entity_id, name):
+        words = normalize(name).split(' ')
+        return {(' '.join(words[i:]), kind, entity_id)
+                for i in range(len(words)) if words[i]}
@@ -0,0 +1,58 @@
+"""Duplicate lookup latency as the catalog grows.
+
+Builds the MinHash index over synthetic names spread across 1000 cities
+for each catalog size, then times candidate lookups. No database is
+needed.
+
+    $ python benchmarks/dedupe.py [SIZES...]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedupe import DuplicateIndex, similarity  # noqa: E402
+
+LOOKUPS = 2000
+
+
+def name(rng):
+    words = [''.join(rng.choice(string.ascii_lowercase)
+                     for _ in range(rng.randint(3, 9)))
+             for _ in range(rng.randint(1, 3))]
+    return ' '.join(words).title()
+
+
+def main(sizes):
+    for size in sizes:
+        rng = random.Random(size)
+        rows = [('venue', i, name(rng), f'City {i % 1000}', 'CA')
+                for i in range(size)]
+        index = DuplicateIndex()
+        started = time.perf_counter()
+        index.rebuild(rows)
+        built = time.perf_counter() - started
+        probes = [rng.choice(rows) for _ in range(LOOKUPS)]
+        # a one-letter typo of an existing name
+        probes = [(entity_id, probe[:-1] + rng.choice(string.ascii_lowercase),
+                   probe, city, state)
+                  for _, entity_id, probe, city, state in probes]
+        started = time.perf_counter()
+        found = [index.candidates('venue', typo, city, state)
+                 for _, typo, _, city, state in probes]
+        lookup = (time.perf_counter() - started) / LOOKUPS
+        # recall over the typos that are similar enough to be reported at all
+        expected = hits = 0
+        for (entity_id, typo, probe, _, _), matches in zip(probes, found):
+            if similarity(typo, probe) >= index.threshold:
+                expected += 1
+                hits += any(match[0] == entity_id for match in matches)
+        print(f"rows={size:<9} build={built:8.1f}s  "
+              f"lookup={lookup * 1e6:8.1f}us  recall={hits / expected:.2%}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
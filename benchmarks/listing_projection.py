@@ -0,0 +1,64 @@
+"""Compare full ORM loads against column projections for listing pages.
+
+Seeds ROWS venues into the configured database inside a transaction,
+measures wall time and peak allocated memory for both strategies, then
+rolls the transaction back so the database is left untouched.
+
+    $ python benchmarks/listing_projection.py [ROWS]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, Venue, venue_summaries  # noqa: E402
+
+
+def measure(label, load):
+    db.session.expunge_all()
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = load()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<12} rows={len(rows):<8} "
+          f"time={elapsed * 1000:9.1f}ms  peak={peak / 1024 / 1024:8.2f}MiB  "
+          f"tracked={len(db.session.identity_map)}")
+
+
+def full_entities():
+    return Venue.query.order_by(Venue.state, Venue.city, Venue.name).all()
+
+
+def main(rows):
+    with app.app_context():
+        db.session.bulk_insert_mappings(Venue, [
+            {
+                "name": f"Benchmark Venue {i}",
+                "city": f"City {i % 500}",
+                "state": "CA",
+                "address": f"{i} Main Street",
+                "phone": "123-123-1234",
+                "genres": ["Jazz", "Folk", "Rock n Roll"],
+                "image_link": "https://example.com/" + "x" * 200,
+                "facebook_link": "https://facebook.com/" + "x" * 200,
+                "website": "https://example.com",
+                "seeking_talent": "true",
+                "seeking_description": "Looking for talent " * 20,
+            }
+            for i in range(rows)
+        ])
+        db.session.flush()
+        try:
+            measure("orm", full_entities)
+            measure("projection", venue_summaries)
+        finally:
+            db.session.rollback()
+            db.session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,76 @@
+"""Measure cold start: import time and time to first response.
+
+Every run is a fresh interpreter, in the default mode and in the
+startup-optimized mode (FYYUR_FAST_STARTUP=1, after precompiling the
+templates). The slowest direct imports of app.py are listed per mode.
+
+    $ python benchmarks/startup.py [RUNS]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+answered = time.perf_counter()
+print(imported - started, answered - imported, response.status_code)
+'''
+
+
+def environment(fast):
+    env = dict(os.environ, FLASK_APP='app',
+               FYYUR_FAST_STARTUP='1' if fast else '0')
+    return env
+
+
+def probe(fast):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT,
+                            env=environment(fast), capture_output=True,
+                            text=True, check=True)
+    wall = time.perf_counter() - started
+    imported, first_response, status = result.stdout.split()[-3:]
+    return float(imported), float(first_response), wall, int(status)
+
+
+def slowest_imports(fast, count=8):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import app'], cwd=ROOT, env=environment(fast),
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # direct imports of app.py sit one level below it
+        if len(name) - len(name.lstrip()) == 3:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(runs):
+    subprocess.run([sys.executable, '-m', 'flask', 'precompile-templates'],
+                   cwd=ROOT, env=environment(True), check=True,
+                   capture_output=True)
+    for fast in (False, True):
+        samples = [probe(fast) for _ in range(runs)]
+        label = 'optimized' if fast else 'default'
+        imported, first, wall, _ = (statistics.median(column)
+                                    for column in zip(*samples))
+        print(f"{label:<10} import={imported * 1000:7.1f}ms  "
+              f"first response={first * 1000:7.1f}ms  "
+              f"process total={wall * 1000:7.1f}ms  (median of {runs})")
+        for cumulative, name in slowest_imports(fast):
+            print(f"    {cumulative / 1000:7.1f}ms  {name}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,90 @@
+"""Compare buffered and streamed rendering of the artists listing.
+
+Seeds ROWS artists into the configured database and commits them, since
+each request runs in its own session. For the buffered page and the
+streamed page under identity, gzip and br encodings it measures time to
+first byte, total time, bytes on the wire and peak allocated memory. The
+seeded artists are deleted again at the end.
+
+    $ python benchmarks/streaming.py [ROWS]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template  # noqa: E402
+
+from app import app, compress, db, Artist, artist_summaries  # noqa: E402
+
+PREFIX = "Benchmark Streaming Artist "
+
+
+def measure(label, respond):
+    tracemalloc.start()
+    started = time.perf_counter()
+    chunks = iter(respond())
+    first = next(chunks, b"")
+    ttfb = time.perf_counter() - started
+    size = len(first) + sum(len(chunk) for chunk in chunks)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<14} ttfb={ttfb * 1000:9.1f}ms  "
+          f"total={elapsed * 1000:9.1f}ms  bytes={size:<10} "
+          f"peak={peak / 1024 / 1024:8.2f}MiB")
+
+
+def buffered():
+    with app.test_request_context('/artists'):
+        page = render_template('pages/artists.html',
+                               artists=artist_summaries(), facets=[])
+        return [page.encode()]
+
+
+def streamed(encoding):
+    client = app.test_client()
+
+    def respond():
+        response = client.get('/artists', buffered=False,
+                              headers={'Accept-Encoding': encoding})
+        try:
+            yield from response.response
+        finally:
+            response.close()
+    return respond
+
+
+def main(rows):
+    with app.app_context():
+        db.session.bulk_insert_mappings(Artist, [
+            {
+                "name": f"{PREFIX}{i}",
+                "city": f"City {i % 500}",
+                "state": "CA",
+                "phone": "123-123-1234",
+                "genres": ["Jazz", "Folk"],
+                "image_link": "https://example.com/" + "x" * 200,
+            }
+            for i in range(rows)
+        ])
+        db.session.commit()
+        try:
+            # build the genre index outside the measurements
+            app.test_client().get('/artists')
+            measure("buffered", buffered)
+            measure("stream", streamed('identity'))
+            measure("stream gzip", streamed('gzip'))
+            if 'br' in compress.available:
+                measure("stream br", streamed('br'))
+        finally:
+            Artist.query.filter(Artist.name.startswith(PREFIX)) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            db.session.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
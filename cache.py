@@ -0,0 +1,127 @@
+"""Read-through LRU/TTL cache of immutable entity snapshots.
+
+Entries are plain namedtuples, never ORM instances, so they can be shared
+across requests and threads after the session that loaded them is closed.
+
+A load that was under way when its key was invalidated (or the cache
+cleared) is returned to its caller but not stored, so an invalidation is
+never undone by a reader that fetched the old row just before it. The cache
+is per process: writes made elsewhere are bounded by the TTL, or sooner by
+whoever calls ``invalidate`` on their behalf.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class SnapshotCache:
+
+    def __init__(self, maxsize=10000, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # ticks of the invalidations made while loads were running
+        self._tick = self._cleared = 0
+        self._invalidated = {}
+        self._loading = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, load):
+        """Cached value for ``key``, calling ``load(key)`` on a miss."""
+        found = self._lookup(key)
+        if found is not None:
+            return found
+        started = self._begin()
+        try:
+            value = load(key)
+            if value is not None:
+                self._store(key, value, started)
+        finally:
+            self._end()
+        return value
+
+    def get_many(self, keys, load_many):
+        """Dict of cached values, loading every miss with one
+        ``load_many(keys)`` call that returns a key -> value dict."""
+        found = {}
+        missing = []
+        for key in set(keys):
+            value = self._lookup(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            started = self._begin()
+            try:
+                loaded = load_many(missing)
+                for key, value in loaded.items():
+                    self._store(key, value, started)
+            finally:
+                self._end()
+            found.update(loaded)
+        return found
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self._loading:
+                self._tick += 1
+                self._invalidated[key] = self._tick
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tick += 1
+            self._cleared = self._tick
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _begin(self):
+        with self._lock:
+            self._loading += 1
+            return self._tick
+
+    def _end(self):
+        with self._lock:
+            self._loading -= 1
+            if not self._loading:
+                self._invalidated.clear()
+
+    def _store(self, key, value, started):
+        with self._lock:
+            if max(self._cleared, self._invalidated.get(key, 0)) > started:
+                return
+            self._entries[key] = (value, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
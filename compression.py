@@ -0,0 +1,137 @@
+"""Negotiated gzip/brotli compression that also works on streamed responses.
+
+Buffered bodies are compressed in one go. Streamed bodies are compressed
+chunk by chunk with a sync flush after each one, so every chunk the view
+yields still reaches the client straight away, only smaller. Brotli is
+used when the ``brotli`` package is installed and the client accepts it;
+it is imported when the first response is compressed with it.
+
+A compressed body is not byte-for-byte the one its view tagged, so its
+ETag is made weak. If-None-Match compares weakly, so 304s still work.
+"""
+import importlib.util
+import zlib
+
+from flask import request
+
+COMPRESSIBLE = ('text/html', 'text/css', 'text/plain', 'text/calendar',
+                'text/event-stream', 'application/json',
+                'application/javascript')
+
+
+def negotiate(accept_encoding, available):
+    """Best of ``available`` encodings the Accept-Encoding header allows."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    for encoding in available:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+class _Gzip:
+
+    def __init__(self, level):
+        self._stream = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return self._stream.compress(data) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._stream.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+
+    def __init__(self, level):
+        import brotli
+        self._stream = brotli.Compressor(quality=min(level, 11))
+
+    def chunk(self, data):
+        return self._stream.process(data) + self._stream.flush()
+
+    def finish(self):
+        return self._stream.finish()
+
+
+class Compress:
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_STREAMS', True)
+        self.level = app.config['COMPRESS_LEVEL']
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.streams = app.config['COMPRESS_STREAMS']
+        # looked up without importing it, which startup would pay for
+        has_brotli = importlib.util.find_spec('brotli') is not None
+        self.available = ('br', 'gzip') if has_brotli else ('gzip',)
+        app.after_request(self.after_request)
+
+    def compressor(self, encoding):
+        return (_Brotli if encoding == 'br' else _Gzip)(self.level)
+
+    def after_request(self, response):
+        response.vary.add('Accept-Encoding')
+        if response.status_code == 304:
+            # a 304 carries the validator the full response would have had
+            if negotiate(request.headers.get('Accept-Encoding'),
+                         self.available) is not None:
+                self._weaken(response)
+            return response
+        if (response.direct_passthrough or
+                response.status_code < 200 or response.status_code >= 300 or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in COMPRESSIBLE):
+            return response
+        encoding = negotiate(request.headers.get('Accept-Encoding'),
+                             self.available)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            if not self.streams:
+                return response
+            response.response = self._stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            compressor = self.compressor(encoding)
+            response.set_data(compressor.chunk(data) + compressor.finish())
+        response.headers['Content-Encoding'] = encoding
+        self._weaken(response)
+        return response
+
+    @staticmethod
+    def _weaken(response):
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+
+    def _stream(self, chunks, encoding):
+        compressor = self.compressor(encoding)
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield compressor.chunk(chunk)
+            yield compressor.finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
@@ -11,3 +11,104 @@ DEBUG = True
 
 # DONE IMPLEMENT DATABASE URL
 SQLALCHEMY_DATABASE_URI = 'postgresql://localhost:5432/fyyur'
+
+# City/state centroids used to geocode venues offline (city,state,lat,lon)
+GAZETTEER_PATH = os.path.join(basedir, 'data', 'gazetteer.csv')
+# Largest k and radius (km) /venues/near accepts; beyond these the geohash
+# cover degenerates into a scan of every venue
+NEAR_MAX_K = 50
+NEAR_MAX_RADIUS = 200.0
+
+# Local SQLite file holding the background job table, its worker pool size,
+# and the seconds a running job's lease lasts without a heartbeat. Serving
+# workers started by gunicorn or `flask run` start their pool when
+# FYYUR_JOBS_AUTOSTART=1; `python app.py` always does.
+JOBS_DATABASE = os.path.join(basedir, 'jobs.db')
+JOB_WORKERS = 2
+JOB_LEASE = 60
+JOBS_AUTOSTART = os.environ.get('FYYUR_JOBS_AUTOSTART') == '1'
+
+# Seconds between a worker's reads of the Change table, which carry writes
+# made by other workers and jobs into its caches and indexes, and the seconds
+# a change is read again in case an older transaction commits after it
+CHANGE_POLL = 1.0
+CHANGE_SETTLE = 10
+# Days of Change rows kept after `flask snapshot` has covered them
+CHANGE_RETENTION = 1
+
+# Cross-request cache of Venue and Artist snapshots (entries per model, seconds)
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300
+
+# Where `flask snapshot` writes the pre-rendered public pages
+SNAPSHOT_DIR = os.path.join(basedir, 'snapshot')
+
+# Startup-optimized mode (FYYUR_FAST_STARTUP=1): cache compiled templates on
+# disk and only load Flask-Migrate when a `flask db` command needs it
+FAST_STARTUP = os.environ.get('FYYUR_FAST_STARTUP') == '1'
+TEMPLATE_CACHE_DIR = os.path.join(basedir, '.template-cache')
+
+# Template chunks buffered per write when streaming listing pages, and
+# response compression (gzip always, brotli when the package is installed)
+STREAM_BUFFER = 64
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 500
+
+# Admission control: at most ADMISSION_CAPACITY requests in flight, of which
+# the expensive endpoints below may use all but ADMISSION_RESERVE, each up to
+# its own limit and at RATE_LIMIT_RATE per second (bursts of
+# RATE_LIMIT_BURST) per client. 'shared' shares the counters between the
+# workers on a host, 'local' keeps them per process.
+ADMISSION_BACKEND = 'local'
+ADMISSION_CAPACITY = 32
+ADMISSION_RESERVE = 8
+ADMISSION_LIMITS = {
+    'search_venues': 4,
+    'search_artists': 4,
+    'shows': 4,
+    'venues': 8,
+    'artists': 8,
+}
+# long-lived connections that would otherwise hold a slot for their lifetime
+ADMISSION_EXEMPT = ('static', 'show_feed_stream')
+ADMISSION_QUEUE_DEPTH = 16
+ADMISSION_QUEUE_TIMEOUT = 0.5
+RATE_LIMIT_RATE = 2.0
+RATE_LIMIT_BURST = 10
+
+# Live feed of new shows (/shows/feed): events buffered per subscriber before
+# it is dropped, recent events kept for Last-Event-ID replay, subscribers per
+# worker, seconds between keepalive comments, seconds between reads of new
+# events and days events are kept. Each subscriber holds a server thread, so
+# keep FEED_MAX_SUBSCRIBERS well below the worker's thread count unless the
+# server is asynchronous (gevent, eventlet).
+FEED_QUEUE_SIZE = 100
+FEED_HISTORY = 256
+FEED_MAX_SUBSCRIBERS = 4
+FEED_HEARTBEAT = 15
+FEED_POLL = 1.0
+FEED_RETENTION = 7
+
+# Days of residency occurrences shown around today on /shows and the detail
+# pages, and the widest window the occurrences API expands at once
+RESIDENCY_WINDOW = 90
+RESIDENCY_MAX_WINDOW = 731
+
+# .ics feeds: seconds clients and proxies may reuse a feed without asking,
+# and the minutes each show occupies in the calendar
+CALENDAR_MAX_AGE = 900
+CALENDAR_SHOW_LENGTH = 120
+
+# Minimum trigram similarity of two names in the same city and state for
+# them to be flagged as possible duplicates
+DEDUPE_THRESHOLD = 0.6
+
+# Per-request profiler: requests sending PROFILE_TOKEN in the X-Profile
+# header are profiled, plus a random PROFILE_SAMPLE_RATE fraction of all
+# requests. Stacks are sampled every PROFILE_INTERVAL seconds; the last
+# PROFILE_KEEP profiles are kept.
+PROFILE_TOKEN = os.environ.get('FYYUR_PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_INTERVAL = 0.001
+PROFILE_DIR = os.path.join(basedir, 'profiles')
+PROFILE_KEEP = 100
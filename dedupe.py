@@ -0,0 +1,210 @@
+"""Near-duplicate name detection with MinHash and locality-sensitive hashing.
+
+Names are compared as sets of character trigrams. Each name gets a MinHash
+signature of ``PERMUTATIONS`` values, cut into ``BANDS`` bands. Two names
+whose Jaccard similarity is ``s`` share at least one band with
+probability ``1 - (1 - s ** ROWS) ** BANDS``. Only names that share a band
+are compared, and only within one block (the normalized city and state),
+so a lookup costs the same however many names there are.
+
+Candidates are confirmed by their exact trigram similarity, so the index
+can miss a pair but never reports one below the threshold.
+
+Signatures are computed with NumPy for many names at a time, and NumPy is
+imported on first use, like in ``matchmaking``. Request handlers and job
+threads share one index, so its buckets are only touched under its lock.
+"""
+import itertools
+import threading
+import zlib
+from collections import defaultdict
+
+from autocomplete import normalize
+
+PERMUTATIONS = 32
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+
+_coefficients = None
+
+
+def coefficients():
+    # multiply-shift hashing with fixed seeds, so signatures agree across
+    # processes and restarts
+    global _coefficients
+    if _coefficients is None:
+        import numpy as np
+        seeds = np.random.default_rng(20240611).integers(
+            0, 2 ** 63, size=(2, PERMUTATIONS), dtype=np.uint64)
+        _coefficients = (seeds[0] * np.uint64(2) + np.uint64(1))[:, None], \
+            seeds[1][:, None]
+    return _coefficients
+
+
+def trigrams(name):
+    text = ' %s ' % normalize(name)
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(first, second):
+    """Jaccard similarity of the trigram sets of two names."""
+    a, b = trigrams(first), trigrams(second)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def signatures(names):
+    """(len(names), PERMUTATIONS) MinHash signatures; empty names get zeros."""
+    import numpy as np
+    shingles = [[zlib.crc32(gram.encode()) for gram in trigrams(name)]
+                for name in names]
+    sizes = np.fromiter((len(grams) for grams in shingles), dtype=np.int64,
+                        count=len(shingles))
+    result = np.zeros((len(names), PERMUTATIONS), dtype=np.uint32)
+    filled = sizes > 0
+    if not filled.any():
+        return result
+    values = np.fromiter(itertools.chain.from_iterable(shingles),
+                         dtype=np.uint64)
+    a, b = coefficients()
+    with np.errstate(over='ignore'):
+        hashed = ((a * values + b) >> np.uint64(32)).astype(np.uint32)
+    starts = np.concatenate(([0], np.cumsum(sizes[filled])[:-1]))
+    result[filled] = np.minimum.reduceat(hashed, starts, axis=1).T
+    return result
+
+
+def block(city, state):
+    return (normalize(city), normalize(state))
+
+
+class DuplicateIndex:
+    """Band buckets per kind, holding an id or a list of ids."""
+
+    def __init__(self, threshold=0.6):
+        self.threshold = threshold
+        self.built = False
+        self._buckets = defaultdict(dict)
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def _keys(self, city, state, signature):
+        # bucket keys are hashes; a collision only adds a candidate that the
+        # exact comparison then throws out
+        where = block(city, state)
+        return [hash((where, band,
+                      signature[band * ROWS:(band + 1) * ROWS].tobytes()))
+                for band in range(BANDS)]
+
+    def _insert(self, buckets, key, entity_id):
+        held = buckets.get(key)
+        if held is None:
+            buckets[key] = entity_id
+        elif isinstance(held, list):
+            held.append(entity_id)
+        else:
+            buckets[key] = [held, entity_id]
+
+    def rebuild(self, entries, chunk_size=10000):
+        """Load (kind, id, name, city, state) rows."""
+        buckets = defaultdict(dict)
+        names = {}
+        entries = iter(entries)
+        for chunk in iter(lambda: list(itertools.islice(entries, chunk_size)),
+                          []):
+            for row, signature in zip(chunk, signatures(
+                    [name for _, _, name, _, _ in chunk])):
+                kind, entity_id, name, city, state = row
+                names[(kind, entity_id)] = (name, city, state)
+                if trigrams(name):
+                    for key in self._keys(city, state, signature):
+                        self._insert(buckets[kind], key, entity_id)
+        with self._lock:
+            self._buckets, self._entries = buckets, names
+            self.built = True
+
+    def add(self, kind, entity_id, name, city, state):
+        if not self.built:
+            return
+        keys = []
+        if trigrams(name):
+            keys = self._keys(city, state, signatures([name])[0])
+        with self._lock:
+            self.discard(kind, entity_id)
+            self._entries[(kind, entity_id)] = (name, city, state)
+            for key in keys:
+                self._insert(self._buckets[kind], key, entity_id)
+
+    def discard(self, kind, entity_id):
+        with self._lock:
+            entry = self._entries.pop((kind, entity_id), None)
+            if entry is None or not trigrams(entry[0]):
+                return
+            name, city, state = entry
+            buckets = self._buckets[kind]
+            for key in self._keys(city, state, signatures([name])[0]):
+                held = buckets.get(key)
+                if held == entity_id:
+                    del buckets[key]
+                elif isinstance(held, list) and entity_id in held:
+                    held.remove(entity_id)
+                    if len(held) == 1:
+                        buckets[key] = held[0]
+
+    def entry(self, kind, entity_id):
+        """(name, city, state) as indexed, or None."""
+        return self._entries.get((kind, entity_id))
+
+    def candidates(self, kind, name, city, state, exclude=None, limit=5):
+        """Up to ``limit`` (id, name, similarity) likely duplicates of a name."""
+        if not trigrams(name):
+            return []
+        found = set()
+        keys = self._keys(city, state, signatures([name])[0])
+        with self._lock:
+            buckets = self._buckets.get(kind, {})
+            for key in keys:
+                held = buckets.get(key)
+                if isinstance(held, list):
+                    found.update(held)
+                elif held is not None:
+                    found.add(held)
+            found.discard(exclude)
+            entries = {entity_id: self._entries.get((kind, entity_id))
+                       for entity_id in found}
+        matches = []
+        for entity_id, entry in entries.items():
+            if entry is None or block(*entry[1:]) != block(city, state):
+                continue
+            score = similarity(name, entry[0])
+            if score >= self.threshold:
+                matches.append((entity_id, entry[0], score))
+        matches.sort(key=lambda match: (-match[2], match[0]))
+        return matches[:limit]
+
+    def pairs(self, kind):
+        """Every (id, id, similarity) pair above the threshold, each once.
+
+        Works on a copy of the buckets taken up front, so entities added or
+        discarded while the caller iterates are not seen."""
+        with self._lock:
+            groups = [sorted(held)
+                      for held in self._buckets.get(kind, {}).values()
+                      if isinstance(held, list)]
+            entries = {entity_id: self._entries.get((kind, entity_id))
+                       for ids in groups for entity_id in ids}
+        seen = set()
+        for ids in groups:
+            for i, first in enumerate(ids):
+                for second in ids[i + 1:]:
+                    if (first, second) in seen:
+                        continue
+                    seen.add((first, second))
+                    one, other = entries[first], entries[second]
+                    if one is None or other is None or \
+                            block(*one[1:]) != block(*other[1:]):
+                        continue
+                    score = similarity(one[0], other[0])
+                    if score >= self.threshold:
+                        yield first, second, score
@@ -0,0 +1,189 @@
+"""Server-Sent Events fan-out for newly listed shows.
+
+Events are written by the app to storage every worker shares, each with a
+stable, increasing id. Each worker process has one ``Broadcaster``, which
+``follow`` keeps reading new events from on a single background thread,
+whoever wrote them. Each event is copied into the bounded queue of every
+subscriber whose filters match. Subscribers are indexed by venue, artist
+and genre, so an event only visits the subscribers that want it.
+
+Every open subscription holds one server thread (or greenlet) for as long
+as the client stays connected, so the number of subscribers per worker
+must stay well below the worker's thread count unless the server is
+asynchronous.
+
+A subscriber that falls more than its queue size behind is disconnected.
+The browser reconnects with ``Last-Event-ID`` and gets the missed events
+replayed from a short history of recent events. The ids are the same in
+every worker and across restarts, and the history is loaded from the
+shared storage when the follower starts, so the reconnect may land on any
+worker.
+"""
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+
+class Subscription:
+
+    def __init__(self, venue_ids=(), artist_ids=(), genres=(), maxsize=100):
+        self.venue_ids = frozenset(venue_ids)
+        self.artist_ids = frozenset(artist_ids)
+        self.genres = frozenset(genres)
+        self.queue = queue.Queue(maxsize)
+        self.closed = False
+
+    def wants(self, event):
+        # filters of different kinds must all match, values of one kind any
+        if self.venue_ids and event['venue_id'] not in self.venue_ids:
+            return False
+        if self.artist_ids and event['artist_id'] not in self.artist_ids:
+            return False
+        if self.genres and self.genres.isdisjoint(event['genres']):
+            return False
+        return True
+
+
+class Broadcaster:
+
+    def __init__(self, history=256, max_subscribers=5000):
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._follower = None
+        self._history = collections.deque(maxlen=history)
+        self._everyone = set()
+        self._by_venue = collections.defaultdict(set)
+        self._by_artist = collections.defaultdict(set)
+        self._by_genre = collections.defaultdict(set)
+        self._count = 0
+        self.dropped = 0
+
+    def _indexes(self, subscription):
+        # each subscription is filed under one of its filters only; publish
+        # checks the rest with ``wants``
+        if subscription.venue_ids:
+            return self._by_venue, subscription.venue_ids
+        if subscription.artist_ids:
+            return self._by_artist, subscription.artist_ids
+        if subscription.genres:
+            return self._by_genre, subscription.genres
+        return None, ()
+
+    def subscribe(self, subscription, last_event_id=None):
+        """Register ``subscription`` or return None when the worker is full."""
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            index, keys = self._indexes(subscription)
+            if index is None:
+                self._everyone.add(subscription)
+            for key in keys:
+                index[key].add(subscription)
+            self._count += 1
+            if last_event_id is not None:
+                for event_id, event in self._history:
+                    if event_id > last_event_id and subscription.wants(event):
+                        subscription.queue.put_nowait((event_id, event))
+                        if subscription.queue.full():
+                            break
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            index, keys = self._indexes(subscription)
+            if index is None:
+                self._everyone.discard(subscription)
+            for key in keys:
+                index[key].discard(subscription)
+                if not index[key]:
+                    del index[key]
+            self._count -= 1
+
+    def follow(self, fetch, interval=1.0):
+        """Publish the events ``fetch(after_id)`` returns, every ``interval``.
+
+        ``fetch(None)`` must return the most recent events; they fill the
+        replay history before the call returns. Started once per process,
+        later calls do nothing.
+        """
+        with self._lock:
+            if self._follower is not None and \
+                    self._follower[0] == os.getpid():
+                return
+            # a forked child inherits the pair but not the thread
+            self._follower = (os.getpid(), None)
+        try:
+            for event_id, event in fetch(None):
+                self.publish(event_id, event)
+        except Exception:
+            self._follower = None
+            raise
+        thread = threading.Thread(target=self._follow, args=(fetch, interval),
+                                  daemon=True, name='feed-follower')
+        self._follower = (os.getpid(), thread)
+        thread.start()
+
+    def _follow(self, fetch, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                for event_id, event in fetch(self._last_id):
+                    self.publish(event_id, event)
+            except Exception as error:
+                # the database may be briefly away; try again next time
+                print('feed follower:', repr(error))
+
+    def publish(self, event_id, event):
+        """Deliver ``event``; ids at or below the last one are ignored."""
+        with self._lock:
+            if event_id <= self._last_id:
+                return
+            self._last_id = event_id
+            self._history.append((event_id, event))
+            targets = set(self._everyone)
+            targets.update(self._by_venue.get(event['venue_id'], ()))
+            targets.update(self._by_artist.get(event['artist_id'], ()))
+            for genre in event['genres']:
+                targets.update(self._by_genre.get(genre, ()))
+        lagging = []
+        for subscription in targets:
+            if not subscription.wants(event):
+                continue
+            try:
+                subscription.queue.put_nowait((event_id, event))
+            except queue.Full:
+                lagging.append(subscription)
+        for subscription in lagging:
+            # its reader has a full queue to drain, so it is not blocked and
+            # notices the close on its next turn
+            self.dropped += 1
+            self.unsubscribe(subscription)
+
+    def stream(self, subscription, heartbeat=15.0):
+        """SSE lines for ``subscription`` until it is closed or dropped."""
+        try:
+            yield 'retry: 2000\n\n'
+            while not subscription.closed:
+                try:
+                    item = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # keeps proxies from timing out the idle connection
+                    yield ': keepalive\n\n'
+                    continue
+                event_id, event = item
+                yield 'id: %d\nevent: show\ndata: %s\n\n' % (
+                    event_id, json.dumps(event))
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': self._count, 'dropped': self.dropped,
+                    'last_event_id': self._last_id}
@@ -0,0 +1,79 @@
+"""In-app inverted index of genres for backends without array indexes.
+
+On PostgreSQL genre filtering and facet counts run in the database against
+GIN indexes on the ``genres`` arrays. Other backends fall back to this
+index, which maps every genre to the set of entity ids carrying it. Each
+process keeps its own; the caller applies writes made elsewhere.
+"""
+import threading
+from collections import defaultdict
+
+from sqlalchemy import String, literal
+from sqlalchemy.dialects import postgresql
+
+
+def contains_all(column, genres):
+    """``column @> genres`` for a PostgreSQL array column.
+
+    The models declare ``genres`` with the generic ``ARRAY`` type, whose
+    ``contains`` is not implemented, so the operator is spelled out.
+
+    >>> from sqlalchemy import ARRAY, Column, MetaData, Table
+    >>> table = Table('Venue', MetaData(), Column('genres', ARRAY(String)))
+    >>> print(contains_all(table.c.genres, ['Jazz']).compile(
+    ...     dialect=postgresql.dialect()))
+    "Venue".genres @> %(param_1)s::VARCHAR[]
+    """
+    return column.op('@>')(literal(list(genres), postgresql.ARRAY(String)))
+
+
+class GenreIndex:
+
+    def __init__(self):
+        self.built = False
+        self._postings = defaultdict(set)
+        self._genres = {}
+        # writes come from request handlers and job threads
+        self._lock = threading.RLock()
+
+    def rebuild(self, rows):
+        # lookups keep using the old postings until the new ones are complete
+        fresh = GenreIndex()
+        for entity_id, genres in rows:
+            fresh._add(entity_id, genres)
+        with self._lock:
+            self._postings, self._genres = fresh._postings, fresh._genres
+            self.built = True
+
+    def update(self, entity_id, genres):
+        with self._lock:
+            if self.built:
+                self.discard(entity_id)
+                self._add(entity_id, genres)
+
+    def discard(self, entity_id):
+        with self._lock:
+            for genre in self._genres.pop(entity_id, ()):
+                self._postings[genre].discard(entity_id)
+
+    def matching(self, genres):
+        """Ids of entities tagged with every genre in ``genres``."""
+        with self._lock:
+            postings = sorted((self._postings.get(genre, set())
+                               for genre in genres), key=len)
+            if not postings:
+                return set(self._genres)
+            return set.intersection(*postings)
+
+    def counts(self, entity_ids):
+        """Number of ``entity_ids`` tagged with each genre."""
+        entity_ids = set(entity_ids)
+        with self._lock:
+            return {genre: len(ids & entity_ids)
+                    for genre, ids in self._postings.items() if ids}
+
+    def _add(self, entity_id, genres):
+        genres = tuple(genres or ())
+        self._genres[entity_id] = genres
+        for genre in genres:
+            self._postings[genre].add(entity_id)
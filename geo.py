@@ -0,0 +1,109 @@
+"""Geohash spatial helpers and the offline gazetteer used for geocoding.
+
+Venues store a geohash next to their coordinates. Every geohash prefix is
+a rectangular cell, so a radius query becomes a handful of indexed prefix
+scans over the cells around the centre, followed by an exact great-circle
+filter over the few candidates they return.
+"""
+import csv
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+PRECISION = 9
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(lat, lon, precision=PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            span, coordinate = lon_range, lon
+        else:
+            span, coordinate = lat_range, lat
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_base32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of a geohash cell."""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+def reach(lat, precision):
+    """Distance in km from the centre cell that its 3x3 block always covers."""
+    height, width = cell_size(precision)
+    parallel = math.cos(math.radians(min(89.9, abs(lat) + height)))
+    return min(height * KM_PER_DEGREE, width * KM_PER_DEGREE * parallel)
+
+
+def neighbourhood(lat, lon, precision):
+    """The cell containing (lat, lon) and its eight neighbours."""
+    height, width = cell_size(precision)
+    cells = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_lat = max(-90.0, min(90.0 - 1e-9, lat + dlat))
+            cell_lon = (lon + dlon + 180.0) % 360.0 - 180.0
+            cells.add(encode(cell_lat, cell_lon, precision))
+    return sorted(cells)
+
+
+def cover(lat, lon, radius_km):
+    """Geohash prefixes whose cells together contain the whole circle."""
+    for precision in range(PRECISION, 0, -1):
+        if reach(lat, precision) >= radius_km:
+            return neighbourhood(lat, lon, precision)
+    return ['']
+
+
+class Gazetteer:
+    """City/state centroids loaded from a local CSV (city,state,lat,lon)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._places = None
+
+    def lookup(self, city, state):
+        if self._places is None:
+            self._places = self._load()
+        return self._places.get(self._key(city, state))
+
+    def _load(self):
+        places = {}
+        with open(self.path, newline='') as handle:
+            for row in csv.DictReader(handle):
+                places[self._key(row['city'], row['state'])] = (
+                    float(row['lat']), float(row['lon']))
+        return places
+
+    @staticmethod
+    def _key(city, state):
+        return (' '.join((city or '').lower().split()), (state or '').upper())
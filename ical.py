@@ -0,0 +1,64 @@
+"""Streaming iCalendar (RFC 5545) output for show feeds.
+
+``calendar`` turns an iterable of ``Event`` into VCALENDAR text one event
+at a time, so a feed is written while its shows are still being read.
+Show times are stored without a time zone, so they are written as
+floating times, which calendar apps show as the venue's local time.
+"""
+import datetime
+from collections import namedtuple
+
+Event = namedtuple('Event', 'uid start summary location url')
+
+_format = '%Y%m%dT%H%M%S'
+
+
+def escape(text):
+    return (str(text).replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Split ``line`` into 75-octet pieces, as content lines require."""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    pieces = []
+    limit = 75
+    while data:
+        cut = min(limit, len(data))
+        # never split a UTF-8 sequence
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        pieces.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = 74
+    return '\r\n '.join(pieces) + '\r\n'
+
+
+def calendar(name, events, stamp, duration=datetime.timedelta(hours=2)):
+    """VCALENDAR text for ``events``, yielded one event at a time.
+
+    ``stamp`` is written as every event's DTSTAMP, so the output only
+    changes when the events do and can carry a strong ETag.
+    """
+    hours, rest = divmod(int(duration.total_seconds()), 3600)
+    length = 'PT%dH%dM' % (hours, rest // 60)
+    stamp = stamp.strftime(_format) + 'Z'
+    yield ('BEGIN:VCALENDAR\r\n'
+           'VERSION:2.0\r\n'
+           'PRODID:-//Fyyur//Shows//EN\r\n'
+           'CALSCALE:GREGORIAN\r\n'
+           'METHOD:PUBLISH\r\n'
+           + fold('X-WR-CALNAME:' + escape(name)))
+    for event in events:
+        yield ('BEGIN:VEVENT\r\n'
+               + fold('UID:' + event.uid)
+               + 'DTSTAMP:' + stamp + '\r\n'
+               + 'DTSTART:' + event.start.strftime(_format) + '\r\n'
+               + 'DURATION:' + length + '\r\n'
+               + fold('SUMMARY:' + escape(event.summary))
+               + fold('LOCATION:' + escape(event.location))
+               + fold('URL:' + event.url)
+               + 'END:VEVENT\r\n')
+    yield 'END:VCALENDAR\r\n'
@@ -0,0 +1,277 @@
+"""In-process background jobs backed by a local SQLite job table.
+
+Jobs are rows in their own SQLite file, so a queued job survives a
+restart and is picked up again by the next process. Each process runs a
+small pool of worker threads that claim one row at a time inside an
+IMMEDIATE transaction and stamp it with an owner token unique to the
+process. A claim is a lease: while the job runs, a heartbeat thread
+renews it every quarter of ``lease`` seconds. Rows whose lease has run
+out, because their process died or hung, go back in the queue; a job
+that finishes after losing its lease leaves the row to its new owner.
+Failed jobs are retried with exponential backoff until they run out of
+attempts.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import closing
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    error TEXT,
+    owner TEXT,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at);
+'''
+
+_columns = ('id', 'name', 'payload', 'status', 'attempts', 'run_at',
+            'created_at', 'finished_at', 'error', 'owner', 'heartbeat_at')
+
+
+class JobQueue:
+
+    def __init__(self, path, context=None, workers=2, max_attempts=3,
+                 poll_interval=1.0, backoff=2.0, lease=60.0):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.lease = lease
+        self._context = context
+        self._handlers = {}
+        self._threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._owner = None
+        self._running = 0
+        self._heartbeat = None
+        with self._connect() as connection:
+            connection.executescript(_schema)
+            # job files created before claims were leases
+            known = {row[1] for row in
+                     connection.execute('PRAGMA table_info(jobs)')}
+            for column, kind in (('owner', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in known:
+                    connection.execute(
+                        f'ALTER TABLE jobs ADD COLUMN {column} {kind}')
+
+    def handler(self, name):
+        def register(function):
+            self._handlers[name] = function
+            return function
+        return register
+
+    def start(self):
+        """Start the worker pool in this process, once; cheap to call again."""
+        if self._threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            self._forked()
+            if self._threads:
+                return
+            self.reclaim()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f'job-worker-{number}')
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout)
+        self._threads = []
+        self._heartbeat = None
+        self._stopping.clear()
+
+    def enqueue(self, name, **payload):
+        if name not in self._handlers:
+            raise KeyError(f'no job handler named {name!r}')
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (name, payload, status, run_at, created_at) "
+                "VALUES (?, ?, 'queued', ?, ?)",
+                (name, json.dumps(payload), now, now))
+            job_id = cursor.lastrowid
+        # only wakes this process's pool, if it runs one; starting it is up
+        # to the serving process
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute(
+                f"SELECT {', '.join(_columns)} FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        return self._as_dict(row) if row else None
+
+    def recent(self, limit=50):
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(_columns)} FROM jobs "
+                "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._as_dict(row) for row in rows]
+
+    def reclaim(self):
+        """Requeue running rows whose lease has expired; returns how many."""
+        expired = time.time() - self.lease
+        with self._connect() as connection:
+            # a plain read first, so idle workers do not queue for the lock
+            if connection.execute(
+                    "SELECT 1 FROM jobs WHERE status = 'running' AND "
+                    "(heartbeat_at IS NULL OR heartbeat_at < ?) LIMIT 1",
+                    (expired,)).fetchone() is None:
+                return 0
+            return connection.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL "
+                "WHERE status = 'running' AND "
+                "(heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (expired,)).rowcount
+
+    def run_pending(self):
+        """Run every due job in the calling thread; returns how many ran."""
+        ran = 0
+        while self._run_one():
+            ran += 1
+        return ran
+
+    def _work(self):
+        while not self._stopping.is_set():
+            if not self._run_one():
+                # another worker process may have died since the last look
+                self.reclaim()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def _run_one(self):
+        job = self._claim()
+        if job is None:
+            return False
+        try:
+            handler = self._handlers[job['name']]
+            if self._context is not None:
+                with self._context():
+                    handler(**job['payload'])
+            else:
+                handler(**job['payload'])
+        except Exception:
+            self._failed(job, traceback.format_exc())
+        else:
+            self._finish(job, 'done', None)
+        finally:
+            with self._lock:
+                self._running -= 1
+        return True
+
+    def _forked(self):
+        # called with the lock held; a forked child inherits the threads'
+        # bookkeeping but not the threads, and must not share the token
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._owner = '%d-%s' % (self._pid, uuid.uuid4().hex[:12])
+            self._threads = []
+            self._heartbeat = None
+
+    def _beat(self):
+        while not self._stopping.wait(self.lease / 4):
+            if not self._running:
+                continue
+            try:
+                with self._connect() as connection:
+                    connection.execute(
+                        "UPDATE jobs SET heartbeat_at = ? "
+                        "WHERE status = 'running' AND owner = ?",
+                        (time.time(), self._owner))
+            except sqlite3.Error:
+                # a missed beat is fine as long as the next one lands
+                traceback.print_exc()
+
+    def _claim(self):
+        with self._lock:
+            self._forked()
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(
+                    target=self._beat, daemon=True, name='job-heartbeat')
+                self._heartbeat.start()
+            # counted before the claim, so the heartbeat never misses it
+            self._running += 1
+        job = None
+        try:
+            job = self._take()
+        finally:
+            if job is None:
+                with self._lock:
+                    self._running -= 1
+        return job
+
+    def _take(self):
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(
+                f"SELECT {', '.join(_columns)} FROM jobs "
+                "WHERE status = 'queued' AND run_at <= ? "
+                "ORDER BY run_at, id LIMIT 1", (time.time(),)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            now = time.time()
+            connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                "owner = ?, heartbeat_at = ? WHERE id = ?",
+                (self._owner, now, row[0]))
+            connection.execute('COMMIT')
+        job = self._as_dict(row)
+        job['attempts'] += 1
+        job['owner'] = self._owner
+        job['heartbeat_at'] = now
+        return job
+
+    def _failed(self, job, error):
+        if job['attempts'] >= self.max_attempts:
+            self._finish(job, 'failed', error)
+            return
+        delay = self.backoff ** job['attempts']
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', run_at = ?, error = ? "
+                "WHERE id = ? AND owner = ?",
+                (time.time() + delay, error, job['id'], job['owner']))
+
+    def _finish(self, job, status, error):
+        # a row whose lease was lost belongs to whoever reclaimed it
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? "
+                "WHERE id = ? AND owner = ?",
+                (status, time.time(), error, job['id'], job['owner']))
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=30,
+                                       isolation_level=None))
+
+    @staticmethod
+    def _as_dict(row):
+        job = dict(zip(_columns, row))
+        job['payload'] = json.loads(job['payload'])
+        return job
+
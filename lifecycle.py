@@ -0,0 +1,37 @@
+"""Running code once a request is over, streamed responses included.
+
+A streamed body is still being produced after the request context is torn
+down, so per-request work that must cover the whole body, like holding an
+admission slot or sampling a profile, ends when the server closes the
+response instead.
+"""
+from flask import g
+
+# WSGI environ key set on requests the app makes to itself, like the page
+# renders of `flask snapshot`; no client waits on them, so they skip
+# admission and never start the job pool
+INTERNAL = 'fyyur.internal'
+
+
+def on_request_done(app, name, callback):
+    """Call ``callback(value, status)`` when the request that set ``g.<name>``
+    is over.
+
+    That is when the server closes the response, or at teardown with status
+    500 when the view failed before a response was made. Requests that did
+    not set ``g.<name>`` are left alone.
+    """
+    def after_request(response):
+        value = g.pop(name, None)
+        if value is not None:
+            status = response.status_code
+            response.call_on_close(lambda: callback(value, status))
+        return response
+
+    def teardown_request(exc):
+        value = g.pop(name, None)
+        if value is not None:
+            callback(value, 500)
+
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,245 @@
+"""Vectorised artist/venue matchmaking.
+
+Each side of the market is held as parallel NumPy column arrays: a genre
+bitset, interned city and state codes, a seeking flag and a show count.
+Ranking one artist against every venue (or the reverse) is then a handful
+of array operations plus an ``argpartition`` for the top k, instead of a
+Python loop over rows. Writes update single slots in place, so the arrays
+never need a full rebuild after the first load. The index is per process;
+writes made by other processes are applied by the caller (see ``set_shows``).
+
+NumPy is imported on first use, so processes that never serve a
+recommendation do not pay for it at startup.
+"""
+import threading
+from collections import Counter, defaultdict
+
+GENRE_WEIGHT = 0.6
+LOCALITY_WEIGHT = 0.25
+HISTORY_WEIGHT = 0.15
+
+_popcount_table = None
+
+
+def popcount(values):
+    global _popcount_table
+    import numpy as np
+    values = np.ascontiguousarray(values, dtype=np.uint32)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    if _popcount_table is None:
+        _popcount_table = np.array([bin(i).count('1') for i in range(256)],
+                                   dtype=np.uint8)
+    return _popcount_table[values.view(np.uint8)].reshape(-1, 4).sum(axis=1)
+
+
+def is_seeking(value):
+    return str(value).lower() in ('true', 't', '1', 'y')
+
+
+class Side:
+    """Growable column arrays for one entity type."""
+
+    def __init__(self, capacity=1024):
+        import numpy as np
+        self.size = 0
+        self.position = {}
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.bits = np.zeros(capacity, dtype=np.uint32)
+        self.genres = np.zeros(capacity, dtype=np.int32)
+        self.city = np.zeros(capacity, dtype=np.int32)
+        self.state = np.zeros(capacity, dtype=np.int32)
+        self.seeking = np.zeros(capacity, dtype=bool)
+        self.shows = np.zeros(capacity, dtype=np.int64)
+
+    def upsert(self, entity_id, bits, city, state, seeking):
+        slot = self.position.get(entity_id)
+        if slot is None:
+            if self.size == len(self.ids):
+                self._grow()
+            slot = self.position[entity_id] = self.size
+            self.size += 1
+            self.ids[slot] = entity_id
+            self.shows[slot] = 0
+        self.bits[slot] = bits
+        self.genres[slot] = bin(bits).count('1')
+        self.city[slot] = city
+        self.state[slot] = state
+        self.seeking[slot] = seeking
+        return slot
+
+    def discard(self, entity_id):
+        # the slot stays allocated but can never be recommended again
+        slot = self.position.pop(entity_id, None)
+        if slot is not None:
+            self.seeking[slot] = False
+            self.ids[slot] = -1
+
+    def _grow(self):
+        import numpy as np
+        for name in ('ids', 'bits', 'genres', 'city', 'state', 'seeking', 'shows'):
+            column = getattr(self, name)
+            grown = np.zeros(len(column) * 2, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+
+class Market:
+    """Everything a rebuild replaces: both sides, the interned places and
+    the booking counts. The matchmaker swaps whole markets in with a single
+    assignment, so a ranking never mixes an old side with a new one."""
+
+    def __init__(self):
+        self.venues = Side()
+        self.artists = Side()
+        self.places = {}
+        self.bookings = {'artist': defaultdict(Counter),
+                         'venue': defaultdict(Counter)}
+
+    def intern(self, key):
+        # code 0 is kept for "unknown" so it never counts as a match
+        return self.places.setdefault(key, len(self.places) + 1)
+
+    def book(self, artist_id, venue_id, count):
+        self.bookings['artist'][artist_id][venue_id] += count
+        self.bookings['venue'][venue_id][artist_id] += count
+        for side, entity_id in ((self.artists, artist_id),
+                                (self.venues, venue_id)):
+            slot = side.position.get(entity_id)
+            if slot is not None:
+                side.shows[slot] += count
+
+
+class Matchmaker:
+
+    def __init__(self, genres):
+        self.genre_bits = {genre: 1 << i for i, genre in enumerate(genres)}
+        # allocated by the first rebuild; writes hold the lock so none is
+        # lost to a rebuild swapping the market underneath it
+        self._market = None
+        self._lock = threading.Lock()
+
+    @property
+    def built(self):
+        return self._market is not None
+
+    def rebuild(self, venues, artists, bookings):
+        """Load rows of (id, genres, city, state, seeking) and
+        (artist_id, venue_id, count)."""
+        fresh = Market()
+        for venue_id, *fields in venues:
+            fresh.venues.upsert(venue_id, *self._encode(fresh, *fields))
+        for artist_id, *fields in artists:
+            fresh.artists.upsert(artist_id, *self._encode(fresh, *fields))
+        for artist_id, venue_id, count in bookings:
+            fresh.book(artist_id, venue_id, count)
+        with self._lock:
+            self._market = fresh
+
+    def update_venue(self, venue_id, genres, city, state, seeking):
+        with self._lock:
+            market = self._market
+            if market is not None:
+                market.venues.upsert(venue_id, *self._encode(
+                    market, genres, city, state, seeking))
+
+    def update_artist(self, artist_id, genres, city, state, seeking):
+        with self._lock:
+            market = self._market
+            if market is not None:
+                market.artists.upsert(artist_id, *self._encode(
+                    market, genres, city, state, seeking))
+
+    def discard_venue(self, venue_id):
+        with self._lock:
+            market = self._market
+            if market is not None:
+                market.venues.discard(venue_id)
+                market.bookings['venue'].pop(venue_id, None)
+
+    def discard_artist(self, artist_id):
+        with self._lock:
+            market = self._market
+            if market is not None:
+                market.artists.discard(artist_id)
+                market.bookings['artist'].pop(artist_id, None)
+
+    def add_show(self, artist_id, venue_id):
+        with self._lock:
+            if self._market is not None:
+                self._market.book(artist_id, venue_id, 1)
+
+    def set_shows(self, artist_id, venue_id, count):
+        """Set the booking count of a pair, e.g. after another process
+        listed or deleted some of its shows."""
+        with self._lock:
+            market = self._market
+            if market is not None:
+                booked = market.bookings['artist'][artist_id][venue_id]
+                if count != booked:
+                    market.book(artist_id, venue_id, count - booked)
+
+    def venues_for(self, artist_id, k=10):
+        """Top ``k`` (venue_id, score) pairs for an artist."""
+        market = self._market
+        if market is None:
+            return []
+        return self._rank(market.artists, market.venues, artist_id,
+                          market.bookings['artist'], k)
+
+    def artists_for(self, venue_id, k=10):
+        """Top ``k`` (artist_id, score) pairs for a venue."""
+        market = self._market
+        if market is None:
+            return []
+        return self._rank(market.venues, market.artists, venue_id,
+                          market.bookings['venue'], k)
+
+    def _encode(self, market, genres, city, state, seeking):
+        bits = 0
+        for genre in genres or ():
+            bits |= self.genre_bits.get(genre, 0)
+        city = ' '.join((city or '').lower().split())
+        return (bits,
+                market.intern((city, state)) if city else 0,
+                market.intern(state) if state else 0,
+                is_seeking(seeking))
+
+    def _rank(self, source, target, source_id, bookings, k):
+        import numpy as np
+        slot = source.position.get(source_id)
+        if slot is None or target.size == 0 or k <= 0:
+            return []
+        n = target.size
+        bits = source.bits[slot]
+        city = source.city[slot]
+        state = source.state[slot]
+
+        overlap = popcount(target.bits[:n] & bits)
+        union = target.genres[:n] + source.genres[slot] - overlap
+        genre = np.divide(overlap, union, out=np.zeros(n), where=union > 0)
+
+        locality = np.zeros(n)
+        if state:
+            locality[target.state[:n] == state] = 0.5
+        if city:
+            locality[target.city[:n] == city] = 1.0
+
+        activity = np.log1p(target.shows[:n].astype(float))
+        history = 0.5 * activity / max(activity.max(), 1.0)
+        # a copy, as writers may add to the counter while this runs
+        booked = dict(bookings.get(source_id) or {})
+        if booked:
+            slots = [target.position[i] for i in booked if i in target.position]
+            counts = [booked[target.ids[s]] for s in slots]
+            history[slots] += 0.5 * np.minimum(counts, 3) / 3
+
+        score = (GENRE_WEIGHT * genre + LOCALITY_WEIGHT * locality +
+                 HISTORY_WEIGHT * history)
+        score[~target.seeking[:n]] = -np.inf
+
+        k = min(k, n)
+        top = np.argpartition(-score, k - 1)[:k]
+        top = top[np.argsort(-score[top], kind='stable')]
+        return [(int(target.ids[i]), float(score[i]))
+                for i in top if np.isfinite(score[i])]
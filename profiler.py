@@ -0,0 +1,339 @@
+"""On-demand profiling of single requests.
+
+A request is profiled when it carries ``PROFILE_TOKEN`` in the
+``X-Profile`` header, and, if ``PROFILE_SAMPLE_RATE`` is above zero, for that fraction of all other
+requests. Nothing is profiled while no token is configured and the rate
+is zero.
+
+A profiled request gets a sampler thread that reads the request thread's
+stack every ``PROFILE_INTERVAL`` seconds. The profile also records every
+SQL statement with its duration and the render time of every template.
+It is saved to ``PROFILE_DIR`` as collapsed stacks (for flamegraph.pl and
+similar tools), as a speedscope file, and as a JSON summary that the
+``/_profiles`` pages list. Streamed responses are profiled until the
+stream is closed.
+"""
+import collections
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from flask import (Blueprint, abort, before_render_template, g,
+                   render_template, request, send_from_directory,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from lifecycle import on_request_done
+
+
+class Profile:
+
+    def __init__(self, thread_id, interval, root):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.root = root
+        self.started = time.perf_counter()
+        self.stacks = collections.Counter()
+        self.queries = []
+        self.templates = []
+        self._rendering = {}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self.started
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def _label(self, code):
+        filename = code.co_filename
+        if filename.startswith(self.root):
+            filename = os.path.relpath(filename, self.root)
+        else:
+            filename = re.sub(r'^.*[\\/](site|dist)-packages[\\/]', '',
+                              filename)
+        return '%s (%s:%d)' % (code.co_name, filename, code.co_firstlineno)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def query_started(self, statement):
+        return self.elapsed(), statement
+
+    def query_finished(self, token, rows):
+        started, statement = token
+        self.queries.append({
+            "statement": statement,
+            "started_ms": round(started * 1000, 3),
+            "duration_ms": round((self.elapsed() - started) * 1000, 3),
+            "rows": rows,
+        })
+
+    def template_started(self, name):
+        self._rendering[name] = self.elapsed()
+
+    def template_finished(self, name):
+        started = self._rendering.pop(name, None)
+        if started is not None:
+            self.templates.append({
+                "name": name,
+                "started_ms": round(started * 1000, 3),
+                "duration_ms": round((self.elapsed() - started) * 1000, 3),
+            })
+
+    def collapsed(self):
+        """Brendan Gregg's folded format: one 'a;b;c count' line per stack."""
+        return ''.join('%s %d\n' % (';'.join(stack), count)
+                       for stack, count in self.stacks.most_common())
+
+    def speedscope(self, name):
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in self.stacks.items():
+            sample = []
+            for label in stack:
+                if label not in index:
+                    index[label] = len(frames)
+                    frames.append({"name": label})
+                sample.append(index[label])
+            samples.append(sample)
+            weights.append(round(count * self.interval * 1000, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "fyyur",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round(self.duration * 1000, 3),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+class Profiler:
+
+    def __init__(self, app=None):
+        self._active = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_TOKEN', None)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_INTERVAL', 0.001)
+        app.config.setdefault('PROFILE_DIR',
+                              os.path.join(app.root_path, 'profiles'))
+        app.config.setdefault('PROFILE_KEEP', 100)
+        self.token = app.config['PROFILE_TOKEN']
+        self.rate = app.config['PROFILE_SAMPLE_RATE']
+        self.interval = app.config['PROFILE_INTERVAL']
+        self.directory = app.config['PROFILE_DIR']
+        self.keep = app.config['PROFILE_KEEP']
+        self.root = app.root_path + os.sep
+        app.before_request(self.before_request)
+        on_request_done(app, 'profile', self.finish)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.register_blueprint(self.blueprint())
+
+    def has_token(self):
+        # never a query parameter, which would leave the token in access logs
+        offered = request.headers.get('X-Profile')
+        return bool(self.token) and offered is not None and \
+            hmac.compare_digest(offered, self.token)
+
+    def wanted(self):
+        if request.endpoint in (None, 'static') or \
+                request.blueprint == 'profiles':
+            return False
+        if self.has_token():
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def allowed(self):
+        """Whether this request may browse the saved profiles."""
+        # a request relayed by a proxy on this host is not a local one
+        local = request.remote_addr in ('127.0.0.1', '::1') and \
+            'X-Forwarded-For' not in request.headers and \
+            'Forwarded' not in request.headers
+        return local or self.has_token()
+
+    def current(self):
+        return self._active.get(threading.get_ident())
+
+    def before_request(self):
+        if not self.wanted():
+            return
+        profile = Profile(threading.get_ident(), self.interval, self.root)
+        self._active[profile.thread_id] = profile
+        # described now, the request is gone by the time a stream closes
+        g.profile = (profile, self.describe())
+        profile.start()
+
+    def describe(self):
+        query = request.query_string.decode('latin-1')
+        return {"method": request.method,
+                "path": request.path + ('?' + query if query else ''),
+                "endpoint": request.endpoint}
+
+    def finish(self, started, status):
+        profile, info = started
+        self._active.pop(profile.thread_id, None)
+        profile.stop()
+        try:
+            self.save(profile, dict(info, status=status))
+        except OSError:
+            print(sys.exc_info())
+
+    def save(self, profile, info):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = '%s-%s' % (time.strftime('%Y%m%dT%H%M%S'),
+                                uuid.uuid4().hex[:6])
+        name = '%s %s' % (info['method'], info['path'])
+        summary = dict(info, id=profile_id, created=time.time(),
+                       duration_ms=round(profile.duration * 1000, 3),
+                       samples=sum(profile.stacks.values()),
+                       interval_ms=profile.interval * 1000,
+                       sql_ms=round(sum(query['duration_ms']
+                                        for query in profile.queries), 3),
+                       queries=profile.queries, templates=profile.templates)
+        base = os.path.join(self.directory, profile_id)
+        with open(base + '.collapsed', 'w') as handle:
+            handle.write(profile.collapsed())
+        with open(base + '.speedscope.json', 'w') as handle:
+            json.dump(profile.speedscope(name), handle)
+        with open(base + '.json', 'w') as handle:
+            json.dump(summary, handle)
+        self.prune()
+
+    def profile_ids(self):
+        """Ids of the saved profiles, newest first by file time."""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json') and \
+                    not filename.endswith('.speedscope.json'):
+                try:
+                    modified = os.path.getmtime(
+                        os.path.join(self.directory, filename))
+                except OSError:
+                    continue
+                found.append((modified, filename[:-len('.json')]))
+        found.sort(reverse=True)
+        return [profile_id for _, profile_id in found]
+
+    def summary(self, profile_id):
+        """The saved summary, or None if it is missing or unreadable."""
+        try:
+            with open(os.path.join(self.directory,
+                                   profile_id + '.json')) as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            # a half-written or damaged file must not break the listing
+            return None
+
+    def summaries(self):
+        return [summary for summary in map(self.summary, self.profile_ids())
+                if summary is not None]
+
+    def prune(self):
+        for profile_id in self.profile_ids()[self.keep:]:
+            for suffix in ('.json', '.collapsed', '.speedscope.json'):
+                try:
+                    os.remove(os.path.join(self.directory,
+                                           profile_id + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        profile = self.current()
+        if profile is not None:
+            conn.info.setdefault('profile_queries', []).append(
+                profile.query_started(statement))
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        profile = self.current()
+        started = conn.info.get('profile_queries')
+        if profile is not None and started:
+            profile.query_finished(started.pop(), cursor.rowcount)
+
+    def _before_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None:
+            profile.template_started(template.name)
+
+    def _after_render(self, sender, template, context, **extra):
+        profile = self.current()
+        if profile is not None:
+            profile.template_finished(template.name)
+
+    def blueprint(self):
+        profiles = Blueprint('profiles', __name__, url_prefix='/_profiles')
+
+        @profiles.before_request
+        def local_only():
+            if not self.allowed():
+                abort(404)
+
+        @profiles.route('')
+        def index():
+            return render_template('pages/profiles.html',
+                                   profiles=self.summaries())
+
+        @profiles.route('/<profile_id>')
+        def detail(profile_id):
+            if not re.fullmatch(r'[\w-]+', profile_id):
+                abort(404)
+            summary = self.summary(profile_id)
+            if summary is None:
+                abort(404)
+            slowest = sorted(summary['queries'],
+                             key=lambda query: query['duration_ms'],
+                             reverse=True)
+            return render_template('pages/profile.html', profile=summary,
+                                   slowest=slowest)
+
+        @profiles.route('/<profile_id>/collapsed')
+        def collapsed(profile_id):
+            return send_from_directory(self.directory,
+                                       profile_id + '.collapsed',
+                                       as_attachment=True)
+
+        @profiles.route('/<profile_id>/speedscope')
+        def speedscope(profile_id):
+            return send_from_directory(self.directory,
+                                       profile_id + '.speedscope.json',
+                                       as_attachment=True)
+
+        return profiles
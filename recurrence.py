@@ -0,0 +1,95 @@
+"""Lazy expansion of recurring shows.
+
+A rule is a first occurrence plus a frequency (daily, weekly or monthly),
+an interval and an optional end, either a last date (``until``) or a
+number of occurrences (``count``). Expansion jumps straight to the first
+occurrence inside the requested window and yields occurrences one at a
+time until the window ends, so an open-ended residency costs only as much
+as the window asked for.
+
+Monthly rules keep the day of the month of the first occurrence and fall
+back to the last day of shorter months.
+
+Exceptions map an occurrence's original start time to its new start time,
+or to None when that occurrence is cancelled.
+"""
+import calendar
+import datetime
+import heapq
+from collections import namedtuple
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+Rule = namedtuple('Rule', 'start frequency interval until count')
+
+_days = {'daily': 1, 'weekly': 7}
+
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    year, month = moment.year + month // 12, month % 12 + 1
+    day = min(moment.day, calendar.monthrange(year, month)[1])
+    return moment.replace(year=year, month=month, day=day)
+
+
+def nth(rule, index):
+    """Start time of occurrence number ``index`` (from 0)."""
+    if rule.frequency == 'monthly':
+        return add_months(rule.start, index * rule.interval)
+    return rule.start + datetime.timedelta(
+        days=_days[rule.frequency] * rule.interval * index)
+
+
+def first_index(rule, start):
+    """Index of the first occurrence at or after ``start``."""
+    if start <= rule.start:
+        return 0
+    if rule.frequency == 'monthly':
+        months = (start.year - rule.start.year) * 12 \
+            + start.month - rule.start.month
+        index = max(0, months // rule.interval - 1)
+    else:
+        step = datetime.timedelta(days=_days[rule.frequency] * rule.interval)
+        index = (start - rule.start) // step
+    while nth(rule, index) < start:
+        index += 1
+    return index
+
+
+def occurrences(rule, start, end):
+    """Start times of the occurrences of ``rule`` in ``[start, end)``."""
+    index = first_index(rule, start)
+    while rule.count is None or index < rule.count:
+        moment = nth(rule, index)
+        if moment >= end or (rule.until is not None and moment > rule.until):
+            return
+        yield moment
+        index += 1
+
+
+def expand(rule, exceptions, start, end):
+    """(original, actual) start times in ``[start, end)``, in actual order.
+
+    Moved occurrences appear at their new time when that falls in the
+    window, wherever their original time is; cancelled ones are left out.
+    """
+    regular = ((moment, moment) for moment in occurrences(rule, start, end)
+               if moment not in exceptions)
+    moved = sorted(
+        ((original, actual) for original, actual in exceptions.items()
+         if actual is not None and start <= actual < end
+         and is_occurrence(rule, original)),
+        key=lambda pair: pair[1])
+    return heapq.merge(regular, moved, key=lambda pair: pair[1])
+
+
+def is_occurrence(rule, moment):
+    """Whether ``moment`` is one of the original start times of ``rule``."""
+    if moment < rule.start:
+        return False
+    index = first_index(rule, moment)
+    if rule.count is not None and index >= rule.count:
+        return False
+    if rule.until is not None and moment > rule.until:
+        return False
+    return nth(rule, index) == moment
@@ -0,0 +1,100 @@
+"""Pre-render public pages to static files.
+
+Pages are rendered through the app's own views and templates with a test
+client, so the output is byte-for-byte what the live site would serve.
+Each URL path is written to ``<output>/<path>/index.html``. Large page
+sets are split across a pool of forked worker processes.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from lifecycle import INTERNAL
+
+STATE_FILE = '.snapshot.json'
+
+_app = None
+
+
+def page_file(output, path):
+    return os.path.join(output, path.strip('/'), 'index.html')
+
+
+def load_state(output):
+    try:
+        with open(os.path.join(output, STATE_FILE)) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(output, state):
+    os.makedirs(output, exist_ok=True)
+    target = os.path.join(output, STATE_FILE)
+    with open(target + '.tmp', 'w') as handle:
+        json.dump(state, handle)
+    os.replace(target + '.tmp', target)
+
+
+def copy_static(app, output):
+    shutil.copytree(app.static_folder, os.path.join(output, 'static'),
+                    dirs_exist_ok=True)
+
+
+def remove(output, paths):
+    for path in paths:
+        try:
+            os.remove(page_file(output, path))
+        except FileNotFoundError:
+            pass
+
+
+def render(app, paths, output, workers=None, chunk_size=200):
+    """Render ``paths`` into ``output``; returns (written, failed) paths.
+
+    Dispose of any pooled database connections before calling this, so
+    forked workers open their own instead of sharing the parent's sockets.
+    """
+    global _app
+    paths = list(paths)
+    chunks = [(output, paths[i:i + chunk_size])
+              for i in range(0, len(paths), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+    written, failed = [], []
+
+    # forked workers inherit the app instead of re-importing it
+    _app = app
+    if workers == 1 or len(chunks) <= 1 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        results = map(_render_chunk, chunks)
+    else:
+        pool = ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks)),
+            mp_context=multiprocessing.get_context('fork'))
+        with pool:
+            results = list(pool.map(_render_chunk, chunks))
+    for chunk_written, chunk_failed in results:
+        written.extend(chunk_written)
+        failed.extend(chunk_failed)
+    return written, failed
+
+
+def _render_chunk(job):
+    output, paths = job
+    client = _app.test_client()
+    client.environ_base[INTERNAL] = True
+    written, failed = [], []
+    for path in paths:
+        # closing the response hands its admission slot back
+        with client.get(path) as response:
+            if response.status_code != 200:
+                failed.append(path)
+                continue
+            target = page_file(output, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as handle:
+                handle.write(response.get_data())
+        written.append(path)
+    return written, failed
@@ -2,3 +2,74 @@ window.parseISOString = function parseISOString(s) {
   var b = s.split(/\D+/);
   return new Date(Date.UTC(b[0], --b[1], b[2], b[3], b[4], b[5], b[6]));
 };
+
+// navbar typeahead: fill the datalist from /autocomplete as the user types
+document.addEventListener('DOMContentLoaded', function() {
+  var input = document.querySelector('input[data-autocomplete]');
+  var list = document.getElementById('search-suggestions');
+  if (!input || !list || !window.fetch) {
+    return;
+  }
+  var timer = null;
+  input.addEventListener('input', function() {
+    clearTimeout(timer);
+    timer = setTimeout(function() {
+      var q = input.value.trim();
+      if (!q) {
+        list.innerHTML = '';
+        return;
+      }
+      fetch('/autocomplete?kind=' + input.dataset.autocomplete +
+            '&limit=8&q=' + encodeURIComponent(q))
+        .then(function(response) { return response.json(); })
+        .then(function(result) {
+          list.innerHTML = '';
+          result.data.forEach(function(match) {
+            var option = document.createElement('option');
+            option.value = match.name;
+            list.appendChild(option);
+          });
+        });
+    }, 100);
+  });
+});
+
+// shows page: add newly listed shows as the server pushes them
+document.addEventListener('DOMContentLoaded', function() {
+  var grid = document.querySelector('.shows[data-feed]');
+  if (!grid || !window.EventSource) {
+    return;
+  }
+  var source = new EventSource(grid.dataset.feed);
+  source.addEventListener('show', function(message) {
+    var show = JSON.parse(message.data);
+    var column = document.createElement('div');
+    column.className = 'col-sm-4';
+    var tile = document.createElement('div');
+    tile.className = 'tile tile-show';
+    var image = document.createElement('img');
+    image.src = show.artist_image_link || '';
+    image.alt = 'Artist Image';
+    tile.appendChild(image);
+    var when = document.createElement('h4');
+    when.textContent = show.start_time;
+    tile.appendChild(when);
+    var artist = document.createElement('h5');
+    var artistLink = document.createElement('a');
+    artistLink.href = '/artists/' + show.artist_id;
+    artistLink.textContent = show.artist_name;
+    artist.appendChild(artistLink);
+    tile.appendChild(artist);
+    var playing = document.createElement('p');
+    playing.textContent = 'playing at';
+    tile.appendChild(playing);
+    var venue = document.createElement('h5');
+    var venueLink = document.createElement('a');
+    venueLink.href = '/venues/' + show.venue_id;
+    venueLink.textContent = show.venue_name;
+    venue.appendChild(venueLink);
+    tile.appendChild(venue);
+    column.appendChild(tile);
+    grid.insertBefore(column, grid.firstChild);
+  });
+});